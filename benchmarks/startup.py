@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Measures how long it takes to import what the viewer needs to bring up
+its main window, each time in a fresh interpreter, and checks that none of
+the modules deferred to first use were loaded along the way.
+
+    python benchmarks/startup.py [--repeat N] [--limit SECONDS] [--file FILE]
+
+With --file, it also opens every viewer of that file twice, offscreen,
+and checks that the second time reuses the viewer built the first time.
+
+Exits non-zero if a deferred module was imported, if the median import
+time exceeds --limit, or if a viewer could not be opened or reopened.
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+# Modules only the viewers need; the main window and file tree must come up without them.
+deferred = [
+    'matplotlib',
+    'matplotlib.pyplot',
+    'matplotlib.animation',
+    'ismrmrdviewer.viewer.ImageViewer',
+    'ismrmrdviewer.viewer.AcquisitionViewer',
+    'ismrmrdviewer.viewer.WaveformViewer',
+    'ismrmrdviewer.viewer.HeaderViewer',
+    'pdb'
+]
+
+probe = """
+import sys, json, time
+start = time.perf_counter()
+import ismrmrdviewer.ui
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed': elapsed, 'loaded': [name for name in %r if name in sys.modules]}))
+""" % (deferred,)
+
+
+def measure():
+    output = subprocess.run([sys.executable, '-c', probe], check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def check_viewers(file_name):
+    "Opens every viewer in file_name twice; returns the number of failures."
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+    from PySide2 import QtWidgets
+    from ismrmrdviewer.ui.FileWidget import FileWidget, viewer_class
+
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    widget = FileWidget(None, file_name)
+
+    items = [widget.tree.topLevelItem(i) for i in range(widget.tree.topLevelItemCount())]
+    failures = 0
+    while items:
+        item = items.pop()
+        item.setExpanded(True)
+        items.extend(item.child(i) for i in range(item.childCount()))
+
+        if getattr(item, 'viewer', None) is None:
+            continue
+
+        try:
+            widget.set_viewer(item.container, viewer_class(item.viewer))
+            first = widget.viewer
+            widget.set_viewer(item.container, viewer_class(item.viewer))
+            reused = widget.viewer is first
+        except Exception as error:
+            print("{}: failed to open: {!r}".format(item.viewer, error))
+            failures += 1
+            continue
+
+        print("{}: opened{}".format(item.viewer, ", reused" if reused else ", but rebuilt when reopened"))
+        failures += not reused
+
+    widget.release()
+    app.processEvents()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup import benchmark.")
+    parser.add_argument('--repeat', type=int, default=5, help="Number of fresh interpreters to time.")
+    parser.add_argument('--limit', type=float, default=None, help="Fail if the median import time exceeds this (in seconds).")
+    parser.add_argument('--file', type=str, default=None, help="ISMRMRD file whose viewers are each opened twice.")
+    args = parser.parse_args()
+
+    results = [measure() for _ in range(args.repeat)]
+    times = [result['elapsed'] for result in results]
+    loaded = sorted(set(name for result in results for name in result['loaded']))
+
+    median = statistics.median(times)
+    print("import ismrmrdviewer.ui: median {:.3f} s, min {:.3f} s, max {:.3f} s over {} runs".format(
+        median, min(times), max(times), len(times)))
+
+    failed = False
+    if loaded:
+        print("Deferred modules imported at startup: " + ", ".join(loaded))
+        failed = True
+    if args.limit is not None and median > args.limit:
+        print("Median import time exceeds the limit of {:.3f} s".format(args.limit))
+        failed = True
+    if args.file and check_viewers(args.file):
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
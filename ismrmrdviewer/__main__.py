@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from PySide2 import QtCore
 import ismrmrdviewer.ui as ui
+from ismrmrdviewer.viewer.utils import CachedDataset
 import sys
 import logging
 import argparse
@@ -16,8 +17,12 @@ def main():
 
     parser = argparse.ArgumentParser(description="Simple ISMRMRD data file viewer.")
     parser.add_argument('file', type=str, nargs='?', help="ISMRMRD data file.")
+    parser.add_argument('--cache-size', type=int, default=CachedDataset.default_byte_budget // 2**20,
+                        help="Memory budget for cached acquisitions and waveforms, per table (in MiB).")
     args = parser.parse_args()
 
+    CachedDataset.default_byte_budget = args.cache_size * 2**20
+
     app = QtWidgets.QApplication(sys.argv)
     app.setApplicationName("ismrmrdviewer")
 
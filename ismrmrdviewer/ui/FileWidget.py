@@ -1,23 +1,41 @@
 
 import ismrmrd
+import importlib
+
+from collections import OrderedDict
 
 from PySide2 import QtWidgets
 from PySide2.QtCore import Qt
 from PySide2.QtGui import QGuiApplication, QCursor
-from ismrmrdviewer.viewer import HeaderViewer, ImageViewer, AcquisitionViewer, WaveformViewer
+from ismrmrdviewer.viewer.utils import release_container_cache
+
+
+def viewer_class(name):
+    "The viewer class `name`, from the module of the same name, imported the first time it is needed."
+    return getattr(importlib.import_module('ismrmrdviewer.viewer.' + name), name)
 
 
 class FileWidget(QtWidgets.QSplitter):
 
+    # Viewers already built are kept, least recently shown first, within these limits.
+    max_viewers = 8
+    viewer_byte_budget = 1024 * 2**20
+
     def __init__(self, parent, file_name):
         super().__init__(parent)
 
+        self.viewers = OrderedDict()
+
         self.tree = QtWidgets.QTreeWidget(self)
         self.tree.setHeaderHidden(True)
-        self.tree.itemClicked.connect(lambda widget, _: self.set_viewer(widget.container, widget.viewer))
+        self.tree.itemClicked.connect(self.__item_clicked)
+        self.tree.itemExpanded.connect(FileWidget.__populate_item)
 
         FileWidget.__populate_tree(self.tree, ismrmrd.File(file_name, mode='r'))
 
+        if self.tree.topLevelItemCount() == 1:
+            self.tree.topLevelItem(0).setExpanded(True)
+
         self.viewer = QtWidgets.QListWidget(self)
 
         self.addWidget(self.tree)
@@ -26,13 +44,53 @@ class FileWidget(QtWidgets.QSplitter):
         self.__balance()
 
     def set_viewer(self, container, factory):
-        QGuiApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
-        viewer = factory(container)
-        self.replaceWidget(1, viewer)
-        self.viewer = viewer
-
+        # Containers are opened once and kept on their tree items, so they identify the viewer.
+        key = (id(container), factory)
+        viewer = self.viewers.pop(key, None)
+        if viewer is None:
+            QGuiApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
+            viewer = factory(container)
+            QGuiApplication.restoreOverrideCursor()
+        self.viewers[key] = viewer
+
+        if viewer is not self.viewer:
+            self.replaceWidget(1, viewer)
+            self.viewer = viewer
+
+        self.__evict()
         self.__balance()
-        QGuiApplication.restoreOverrideCursor()
+
+    def release(self):
+        "Releases every cached viewer, and the data they shared through the containers opened."
+        while self.viewers:
+            FileWidget.__release(self.viewers.popitem()[1])
+
+        items = [self.tree.topLevelItem(i) for i in range(self.tree.topLevelItemCount())]
+        while items:
+            item = items.pop()
+            if getattr(item, 'container', None) is not None:
+                release_container_cache(item.container)
+            items.extend(item.child(i) for i in range(item.childCount()))
+
+    def __evict(self):
+        # The viewer shown is the most recently used, so it is never evicted.
+        while len(self.viewers) > 1 and (len(self.viewers) > self.max_viewers or
+                                         self.__viewer_bytes() > self.viewer_byte_budget):
+            FileWidget.__release(self.viewers.popitem(last=False)[1])
+
+    def __viewer_bytes(self):
+        return sum(viewer.nbytes() for viewer in self.viewers.values() if hasattr(viewer, 'nbytes'))
+
+    @staticmethod
+    def __release(viewer):
+        if hasattr(viewer, 'release'):
+            viewer.release()
+        viewer.deleteLater()
+
+    def __item_clicked(self, item, _):
+        viewer = getattr(item, 'viewer', None)
+        if viewer is not None:
+            self.set_viewer(item.container, viewer_class(viewer))
 
     def __balance(self):
         self.setStretchFactor(0, 1)
@@ -41,26 +99,42 @@ class FileWidget(QtWidgets.QSplitter):
     @staticmethod
     def __available_contents(container):
 
-        viewers = {
-            'header': ('Header', HeaderViewer),
-            'images': ('Images', ImageViewer),
-            'waveforms': ('Waveforms', WaveformViewer),
-            'acquisitions': ('Acquisitions', AcquisitionViewer)
+        # Viewers are named rather than imported here; each viewer module is
+        # only loaded the first time one of its items is clicked.
+        contents = {
+            'header': ('Header', 'HeaderViewer'),
+            'images': ('Images', 'ImageViewer'),
+            'waveforms': ('Waveforms', 'WaveformViewer'),
+            'acquisitions': ('Acquisitions', 'AcquisitionViewer')
         }
 
-        return [viewers[key] for key in container.available()]
+        return [contents[key] for key in container.available()]
 
     @staticmethod
     def __populate_tree(node, container):
-
+        # Groups are only opened, and their children created, when first
+        # expanded; until then a placeholder child makes them expandable.
         for item in container:
 
             child = QtWidgets.QTreeWidgetItem(node, [item])
-            child.setExpanded(True)
+            child.parent_container = container
+            child.container = None
+            child.populated = False
+            QtWidgets.QTreeWidgetItem(child, ["..."])
+
+    @staticmethod
+    def __populate_item(item):
+        if getattr(item, 'populated', True):
+            return
+        item.populated = True
+        item.takeChildren()
+
+        if item.container is None:
+            item.container = item.parent_container[item.text(0)]
 
-            for content, viewer in FileWidget.__available_contents(container[item]):
-                content = QtWidgets.QTreeWidgetItem(child, [content])
-                content.container = container[item]
-                content.viewer = viewer
+        for content, viewer in FileWidget.__available_contents(item.container):
+            content = QtWidgets.QTreeWidgetItem(item, [content])
+            content.container = item.container
+            content.viewer = viewer
 
-            FileWidget.__populate_tree(child, container[item])
+        FileWidget.__populate_tree(item, item.container)
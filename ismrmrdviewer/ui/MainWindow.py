@@ -40,6 +40,18 @@ class MainWindow(QtWidgets.QMainWindow):
     def open_file(self, file_name):
         logging.info(f"Opening file: {file_name}")
         self.setWindowFilePath(file_name)
+
+        self.release()
         self.setCentralWidget(FileWidget(self, file_name))
 
+    def release(self):
+        "Releases the viewers of the open file, stopping their background work."
+        current = self.centralWidget()
+        if isinstance(current, FileWidget):
+            current.release()
+
+    def closeEvent(self, event):
+        self.release()
+        super().closeEvent(event)
+
 
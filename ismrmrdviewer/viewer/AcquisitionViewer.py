@@ -1,3 +1,4 @@
+import time
 import logging
 
 from PySide2 import QtWidgets, QtCore, QtGui
@@ -5,11 +6,13 @@ from PySide2.QtCore import Qt
 
 import numpy as np
 import matplotlib as mpl
-import matplotlib.pyplot as plt
-import matplotlib.figure as figure
+from matplotlib.figure import Figure
 from matplotlib.backends.backend_qt5agg import FigureCanvas
+from matplotlib.collections import LineCollection
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
-from .utils import CachedDataset
+from .utils import CachedDataset, read_headers, header_column, row_ranges, minmax_decimate, time_index
+from .HeaderProxyModel import HeaderProxyModel, add_sort_actions
+from .workers import LatestTask
 
 
 
@@ -71,6 +74,18 @@ def __acquisition_flag_names():
 acquisition_flags = __acquisition_flag_names() 
 
 
+def decode_flags(flags):
+    # Decode each distinct bitfield once; rows refer to their bitfield through the inverse index.
+    values, inverse = np.unique(flags, return_inverse=True)
+    bits = np.array(list(acquisition_flags.keys()), dtype=np.uint64)
+    names = list(acquisition_flags.values())
+
+    present = (values[:, np.newaxis] & bits) != 0
+    labels = [[names[i] for i in np.flatnonzero(row)] for row in present]
+
+    return values, inverse.reshape(-1), labels
+
+
 acquisition_header_fields = [
     ('version', 'Version', "ISMRMRD Version"),
     ('flags', 'Flags', "Acquisition flags bitfield."),
@@ -107,24 +122,60 @@ acquisition_header_fields = [
 ]
 
 
+encoding_counters = ('average', 'slice', 'contrast', 'phase', 'repetition', 'set', 'segment')
+
+
+class EncodingIndex:
+    """
+    Inverted index from encoding counter tuples (see encoding_counters) to
+    the rows carrying them. Rows are grouped once, with a single lexsort,
+    so looking up a combination of counters never scans the headers.
+    """
+
+    def __init__(self, idx):
+        keys = np.stack([idx[counter] for counter in encoding_counters], axis=1)
+
+        self.order = np.lexsort(keys.T[::-1])
+        ordered = keys[self.order]
+
+        boundaries = np.flatnonzero(np.any(ordered[1:] != ordered[:-1], axis=1)) + 1
+        starts = np.r_[0, boundaries]
+        stops = np.r_[boundaries, len(ordered)]
+
+        self.groups = {tuple(ordered[start].tolist()): (start, stop)
+                       for start, stop in zip(starts.tolist(), stops.tolist()) if start < stop}
+
+    def values(self, counter):
+        position = encoding_counters.index(counter)
+        return sorted(set(key[position] for key in self.groups))
+
+    def rows(self, **counters):
+        "Sorted rows matching the given counter values; counters left out match anything."
+        selected = [(encoding_counters.index(counter), value) for counter, value in counters.items()]
+        parts = [self.order[start:stop] for key, (start, stop) in self.groups.items()
+                 if all(key[position] == value for position, value in selected)]
+
+        if not parts:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate(parts))
+
+
 class AcquisitionModel(QtCore.QAbstractTableModel):
 
     def __init__(self, container):
         super().__init__()
         self.acquisitions = CachedDataset(container.acquisitions)
+        self.headers = read_headers(container, 'acquisitions')
+        self.columns = [header_column(self.headers, attribute) for attribute, _, _ in acquisition_header_fields]
+
+        self.flag_values, self.flag_index, labels = decode_flags(self.headers['flags'])
+        self.flag_labels = [', '.join(label) for label in labels]
+        self.flag_tooltips = ['\n'.join(label) or "No flags set" for label in labels]
+
+        self.encoding_index = EncodingIndex(self.headers['idx'])
 
         self.data_handlers = {
-            'flags': self.__flags_handler,
-            'idx.kspace_encode_step_1': self.__encoding_counters_handler,
-            'idx.kspace_encode_step_2': self.__encoding_counters_handler,
-            'idx.average': self.__encoding_counters_handler,
-            'idx.slice': self.__encoding_counters_handler,
-            'idx.contrast': self.__encoding_counters_handler,
-            'idx.phase': self.__encoding_counters_handler,
-            'idx.repetition': self.__encoding_counters_handler,
-            'idx.set': self.__encoding_counters_handler,
-            'idx.segment': self.__encoding_counters_handler,
-            'idx.user': self.__user_encoding_counters_handler,
+            'idx.user': self.__array_handler,
             'physiology_time_stamp': self.__array_handler,
             'channel_mask': self.__array_handler,
             'position': self.__array_handler,
@@ -138,7 +189,7 @@ class AcquisitionModel(QtCore.QAbstractTableModel):
 
 
     def rowCount(self, _=None):
-        return len(self.acquisitions)
+        return len(self.headers)
 
     def columnCount(self, _=None):
         return len(acquisition_header_fields)
@@ -161,55 +212,44 @@ class AcquisitionModel(QtCore.QAbstractTableModel):
         attribute, _, tooltip = acquisition_header_fields[index.column()]
 
         if role == Qt.DisplayRole:
-            acquisition = self.acquisitions[index.row()]
-            handler = self.data_handlers.get(attribute, lambda acq, attr: getattr(acq, attr))
-            return handler(acquisition, attribute)
+            if attribute == 'flags':
+                return self.flag_labels[self.flag_index[index.row()]]
+            value = self.columns[index.column()][index.row()]
+            handler = self.data_handlers.get(attribute, self.__scalar_handler)
+            return handler(value)
         if role == Qt.ToolTipRole:
             if attribute == 'flags':
-                # decode flag names from bitfield
-                acquisition = self.acquisitions[index.row()]
-                flags = self.acquisitions[index.row()].flags
-                tooltip = self.__get_flags_tooltip(flags)
+                return self.flag_tooltips[self.flag_index[index.row()]]
 
             return tooltip
 
         return None
 
-    def num_coils(self):
-        return self.acquisitions[0].active_channels
+    def column(self, attribute):
+        return header_column(self.headers, attribute)
 
-    @staticmethod
-    def __flag_labels(flags):
-        return [label for flag,label in  acquisition_flags.items() if flags & flag]        
+    def sort_key(self, column):
+        return self.columns[column]
 
-    @staticmethod
-    def __flags_handler(acquisition, attribute):
-        return ', '.join(AcquisitionModel.__flag_labels(getattr(acquisition,attribute)))
+    def num_coils(self):
+        return int(self.headers['active_channels'][0])
 
-    @staticmethod
-    def __array_handler(acquisition, attribute):
-        array = getattr(acquisition, attribute)
-        return ', '.join([str(item) for item in array])
+    def present_flags(self):
+        present = int(np.bitwise_or.reduce(self.flag_values)) if len(self.flag_values) else 0
+        return [(flag, label) for flag, label in acquisition_flags.items() if present & flag]
+
+    def flag_mask(self, hidden):
+        "Boolean row mask; false for rows with any of the hidden flags set."
+        shown = (self.flag_values & np.uint64(hidden)) == 0
+        return shown[self.flag_index]
 
     @staticmethod
-    def __encoding_counters_handler(acquisition, attribute):
-        return getattr(acquisition.idx, attribute[4:])
+    def __scalar_handler(value):
+        return value.item()
 
     @staticmethod
-    def __user_encoding_counters_handler(acquisition, attribute):
-        array = getattr(acquisition.idx, attribute[4:])
+    def __array_handler(array):
         return ', '.join([str(item) for item in array])
-    
-  
-    @staticmethod
-    def __get_flags_tooltip(flags):
-        labels = AcquisitionModel.__flag_labels(flags)
-        tooltip = '\n'.join(labels)
-        if not tooltip:
-            # fill empty tooltip
-            tooltip = "No flags set"
-  
-        return tooltip
 
 
 class AcquisitionTable(QtWidgets.QTableView):
@@ -222,6 +262,59 @@ class AcquisitionTable(QtWidgets.QTableView):
         super().selectionChanged(selected, deselected)
         self.selection_changed.emit()
 
+    def selected_rows(self):
+        "Sorted selected rows, read from the selection ranges rather than cell by cell."
+        ranges = [np.arange(selection.top(), selection.bottom() + 1) for selection in self.selectionModel().selection()]
+        if not ranges:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(ranges))
+
+    def select_rows(self, rows):
+        "Selects whole rows, given sorted, as one selection range per run of consecutive rows."
+        model = self.model()
+        last = model.columnCount() - 1
+
+        selection = QtCore.QItemSelection()
+        for start, stop in row_ranges(rows):
+            selection.select(model.index(start, 0), model.index(stop - 1, last))
+
+        self.selectionModel().select(selection, QtCore.QItemSelectionModel.ClearAndSelect)
+
+
+class SelectionPresetGUI(QtWidgets.QWidget):
+    selected = QtCore.Signal(object)
+
+    def __init__(self, index):
+        super().__init__()
+        layout = QtWidgets.QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+
+        self.selectors = {}
+        for counter in encoding_counters:
+            values = index.values(counter)
+            if len(values) < 2:
+                continue
+
+            selector = QtWidgets.QComboBox()
+            selector.addItem(f"{counter.capitalize()}: Any", userData=None)
+            for value in values:
+                selector.addItem(f"{counter.capitalize()}: {value}", userData=value)
+
+            layout.addWidget(selector)
+            self.selectors[counter] = selector
+
+        select = QtWidgets.QPushButton("Select")
+        select.clicked.connect(lambda: self.selected.emit(self.counters()))
+        layout.addWidget(select)
+        layout.addStretch()
+
+        self.setLayout(layout)
+        self.setVisible(bool(self.selectors))
+
+    def counters(self):
+        return {counter: selector.currentData() for counter, selector in self.selectors.items()
+                if selector.currentData() is not None}
+
 
 class AcquisitionControlGUI(QtWidgets.QWidget):
 
@@ -239,6 +332,10 @@ class AcquisitionControlGUI(QtWidgets.QWidget):
         self.__set_num_channels(num_channels)
         layout.addWidget(self.channel_selector)
 
+        self.fast_render = QtWidgets.QCheckBox("Fast render")
+        self.fast_render.setToolTip("Draw decimated traces as a single collection per axis.")
+        layout.addWidget(self.fast_render)
+
         self.setLayout(layout)
 
     def __set_num_channels(self, num_channels):
@@ -258,42 +355,93 @@ class AcquisitionControlGUI(QtWidgets.QWidget):
     def axes_titles(self):
         return self.data_processing.currentData()["names"]
 
-    def transform_acquisition(self, acq):
-        return self.data_processing.currentData()["transform"](self.channel_selector.currentData()["selector"](acq))
+    def transform(self):
+        "Captures the current settings, so the transform can be applied off the GUI thread."
+        process = self.data_processing.currentData()["transform"]
+        select = self.channel_selector.currentData()["selector"]
+        return lambda acq: process(select(acq))
+
+
+def acquisition_trace(acquisition, transform):
+    acquisition1, acquisition2 = transform(acquisition.data.T)
+    x_scale = np.arange(acquisition1.shape[0]) * acquisition.sample_time_us
+    return acquisition.scan_counter, x_scale, acquisition1, acquisition2
+
+
+def trajectory_trace(acquisition):
+    x_scale = np.arange(acquisition.traj.shape[0]) * acquisition.sample_time_us
+    return acquisition.scan_counter, x_scale, acquisition.traj
 
 
 class AcquisitionPlotter(FigureCanvas):
 
+    # Above this many traces, plot() switches to the batched renderer even if fast is off.
+    max_artists = 64
+    max_legend_entries = 16
+
     def __init__(self):
 
-        self.figure = mpl.figure.Figure()
+        self.figure = Figure()
         self.axis = self.figure.subplots(2, 1, sharex='col')
         self.figure.subplots_adjust(hspace=0)
 
         self.legend = mpl.legend.Legend(self.figure, [], [])
         self.figure.legends.append(self.legend)
+        self.fast = False
         super().__init__(self.figure)
 
     def clear(self):
         for ax in self.axis:
             ax.clear()
 
-    def plot(self, acquisitions, formatter, labeler):
+    def plot(self, traces, labeler):
+        "Plots (scan_counter, x_scale, data1, data2) traces, as produced by acquisition_trace."
+        count = sum(acquisition1.shape[1] for _, _, acquisition1, _ in traces)
 
-        for acquisition in acquisitions:
-            acquisition1, acquisition2 = formatter(acquisition)
-            x_step = acquisition.sample_time_us
-            x_scale = np.arange(0, acquisition1.shape[0] * x_step, x_step)
-            for coil, acq1 in enumerate(acquisition1.T):
-                self.axis[0].plot(x_scale, acq1, label=labeler(acquisition.scan_counter, coil))
-            self.axis[1].plot(x_scale, acquisition2)
+        if self.fast or count > self.max_artists:
+            handles, labels = self.__plot_collections(traces, labeler, count)
+        else:
+            handles, labels = self.__plot_lines(traces, labeler)
 
-        handles, labels = self.axis[0].get_legend_handles_labels()
         self.legend = mpl.legend.Legend(self.figure, handles, labels)
         self.figure.legends[0] = self.legend
 
         self.figure.canvas.draw()
 
+    def __plot_lines(self, traces, labeler):
+        for scan, x_scale, acquisition1, acquisition2 in traces:
+            for coil, acq1 in enumerate(acquisition1.T):
+                self.axis[0].plot(x_scale, acq1, label=labeler(scan, coil))
+            self.axis[1].plot(x_scale, acquisition2)
+
+        handles, labels = self.axis[0].get_legend_handles_labels()
+        if len(handles) > self.max_legend_entries:
+            handles = handles[:self.max_legend_entries - 1] + [mpl.lines.Line2D([], [], linestyle='none')]
+            labels = labels[:self.max_legend_entries - 1] + [f"... {len(labels) - self.max_legend_entries + 1} more"]
+        return handles, labels
+
+    def __plot_collections(self, traces, labeler, count):
+        # One LineCollection per axis, each trace reduced to its min/max envelope at the axis' pixel width.
+        colors = mpl.rcParams['axes.prop_cycle'].by_key()['color']
+        trace_colors = [colors[i % len(colors)] for i in range(count)]
+
+        for ax, part in zip(self.axis, (2, 3)):
+            bins = max(int(ax.bbox.width), 1)
+            segments = []
+            for trace in traces:
+                x_scale, y = minmax_decimate(trace[1], trace[part], bins)
+                segments.extend(np.column_stack((x_scale, component)) for component in y.T)
+
+            ax.add_collection(LineCollection(segments, colors=trace_colors[:len(segments)], linewidths=1))
+            ax.autoscale_view()
+
+        if count <= self.max_legend_entries:
+            labels = [labeler(scan, coil) for scan, _, acquisition1, _ in traces for coil in range(acquisition1.shape[1])]
+            handles = [mpl.lines.Line2D([], [], color=color) for color in trace_colors]
+            return handles, labels
+
+        return [mpl.lines.Line2D([], [], color=trace_colors[0])], [f"{count} traces from {len(traces)} acquisitions"]
+
     def set_titles(self, titles):
         for ax, title in zip(self.axis, titles):
             ax.set_title(title, loc="right")
@@ -310,27 +458,31 @@ class TrajectoryControlGUI(QtWidgets.QWidget):
 
         self.setLayout(layout)
 
-    def update_available_trajectory_dimensions(self, acquisitions):
-        available = max([acq.traj.shape[1] for acq in acquisitions])
-
+    def update_available_trajectory_dimensions(self, available):
         selected = self.trajectory_selector.currentIndex()
 
         self.trajectory_selector.clear()
         for dim in range(available):
-            self.trajectory_selector.addItem("Dimension: " + str(dim),
-                                             userData=(dim, lambda acq, d: str((acq.scan_counter, d))))
+            self.trajectory_selector.addItem("Dimension: " + str(dim), userData=('time', dim))
+        if available >= 2:
+            self.trajectory_selector.addItem("kx / ky", userData=('k-space', 2))
+        if available >= 3:
+            self.trajectory_selector.addItem("kx / ky / kz", userData=('k-space', 3))
 
-        self.trajectory_selector.setCurrentIndex(selected)
+        self.trajectory_selector.setCurrentIndex(min(selected, self.trajectory_selector.count() - 1))
 
-    def select(self, acquisition):
-        dim, labeller = self.trajectory_selector.currentData() or self.trajectory_selector.itemData(0)
-        return acquisition.traj[:, dim], labeller(acquisition, dim)
+    def mode(self):
+        return self.trajectory_selector.currentData() or ('time', 0)
 
 
 class TrajectoryPlotter(FigureCanvas):
 
+    # Scatter plots of more points than this are drawn from an evenly strided subset.
+    max_points = 200000
+    max_legend_entries = 16
+
     def __init__(self):
-        self.figure = mpl.figure.Figure()
+        self.figure = Figure()
         self.axis = self.figure.subplots(1, 1)
         self.legend = mpl.legend.Legend(self.figure, [], [])
         self.figure.legends.append(self.legend)
@@ -339,42 +491,275 @@ class TrajectoryPlotter(FigureCanvas):
     def clear(self):
         self.axis.clear()
 
-    def plot(self, acquisitions, select):
+    def set_mode(self, mode):
+        three_dimensional = mode == ('k-space', 3)
+        if three_dimensional == (self.axis.name == '3d'):
+            return
 
-        for acquisition in acquisitions:
+        if three_dimensional:
+            import mpl_toolkits.mplot3d  # noqa: F401  Registers the '3d' projection.
 
-            if acquisition.traj.size == 0:
-                continue
+        self.figure.clear()
+        self.axis = self.figure.add_subplot(1, 1, 1, projection='3d' if three_dimensional else None)
+        self.legend = mpl.legend.Legend(self.figure, [], [])
+        self.figure.legends.append(self.legend)
 
-            x_step = acquisition.sample_time_us
-            x_scale = np.arange(0, acquisition.traj.shape[0] * x_step, x_step)
-            trajectory, label = select(acquisition)
-            self.axis.plot(x_scale, trajectory, label=label)
+    def plot(self, mode, trajectories):
+        kind, dim = mode
+        if kind == 'k-space':
+            handles, labels = self.__plot_kspace(trajectories, dim)
+        else:
+            handles, labels = self.__plot_time(trajectories, dim)
 
-        handles, labels = self.axis.get_legend_handles_labels()
         self.legend = mpl.legend.Legend(self.figure, handles, labels)
         self.figure.legends = [self.legend]
         self.figure.canvas.draw()
 
+    def __plot_time(self, trajectories, dim):
+        trajectories = [(scan, x_scale, trajectory[:, dim]) for scan, x_scale, trajectory in trajectories
+                        if trajectory.shape[1] > dim]
+
+        bins = max(int(self.axis.bbox.width), 1)
+        segments = [np.column_stack(minmax_decimate(x_scale, trajectory, bins)) for _, x_scale, trajectory in trajectories]
+
+        colors = mpl.rcParams['axes.prop_cycle'].by_key()['color']
+        trace_colors = [colors[i % len(colors)] for i in range(len(segments))]
+        self.axis.add_collection(LineCollection(segments, colors=trace_colors, linewidths=1))
+        self.axis.autoscale_view()
+
+        if len(trajectories) <= self.max_legend_entries:
+            return ([mpl.lines.Line2D([], [], color=color) for color in trace_colors],
+                    [str((scan, dim)) for scan, _, _ in trajectories])
+        return [mpl.lines.Line2D([], [], color=trace_colors[0])], [f"{len(trajectories)} trajectories"]
+
+    def __plot_kspace(self, points, dim):
+        count = len(points)
+        if count > self.max_points:
+            points = points[::-(-count // self.max_points)]
+
+        self.axis.scatter(*points[:, :dim].T, s=1, marker='.', linewidths=0)
+        self.axis.set_xlabel("kx")
+        self.axis.set_ylabel("ky")
+        if dim == 3:
+            self.axis.set_zlabel("kz")
+        else:
+            self.axis.set_aspect('equal', adjustable='datalim')
+
+        if count <= self.max_points:
+            return [], []
+        return [mpl.lines.Line2D([], [], linestyle='none')], [f"{len(points)} of {count} samples"]
+
     def set_title(self, title):
         self.axis.set_title(title, loc="right")
 
 
+class PhysiologyPlotter(FigureCanvas):
+    """
+    The waveform records that were recording during the selected
+    acquisitions, in seconds from the start of the file, with a line at
+    each acquisition.
+    """
+
+    def __init__(self):
+        self.figure = Figure()
+        self.axis = self.figure.subplots(1, 1)
+        super().__init__(self.figure)
+
+    def clear(self):
+        self.axis.clear()
+
+    def plot(self, windows, markers):
+        "Plots (waveform_id, x, data) windows, and markers at the given times."
+        colors = mpl.rcParams['axes.prop_cycle'].by_key()['color']
+        labelled = set()
+        for waveform_id, x, data in windows:
+            color = colors[waveform_id % len(colors)]
+            for channel in data.T:
+                label = None if waveform_id in labelled else "Waveform {}".format(waveform_id)
+                self.axis.plot(x, channel, color=color, linewidth=0.5, label=label)
+                labelled.add(waveform_id)
+
+        if len(markers):
+            self.axis.vlines(markers, 0, 1, transform=self.axis.get_xaxis_transform(), colors='k', alpha=0.3)
+        if labelled:
+            self.axis.legend(loc='upper right')
+
+        self.axis.set_xlabel("Time (s)")
+        self.figure.canvas.draw()
+
+
+class OccupancyMap:
+    """
+    Per-readout, per-channel energy of every acquisition in the file. It is
+    filled in block by block on a worker thread, so memory use follows the
+    number of readouts rather than the size of the file, and binned into an
+    encode step 1 by step 2 (or by scan counter) map for display. Blocks
+    are sized from the headers so each read stays within byte_budget.
+    """
+
+    block_size = 1024
+    byte_budget = 32 * 2**20
+    max_columns = 1024
+
+    def __init__(self, model):
+        self.model = model
+        channels = int(model.headers['active_channels'].max()) if model.rowCount() else 0
+        self.energy = np.zeros((model.rowCount(), channels), dtype=np.float32)
+        self.computed = 0
+
+        # Payload bytes up to each row: complex64 samples, and float32 trajectory.
+        samples = model.headers['number_of_samples'].astype(np.int64)
+        sizes = samples * (8 * model.headers['active_channels'].astype(np.int64) +
+                           4 * model.headers['trajectory_dimensions'].astype(np.int64))
+        self.offsets = np.concatenate(([0], np.cumsum(sizes)))
+
+    def block_stop(self, start):
+        "End of the block starting at row start; at least one row, at most block_size, and byte_budget where possible."
+        stop = int(np.searchsorted(self.offsets, self.offsets[start] + self.byte_budget, side='right')) - 1
+        return min(max(stop, start + 1), start + self.block_size, len(self.energy))
+
+    def compute(self, job):
+        "Runs on a worker thread; picks up where an earlier, cancelled pass stopped."
+        dataset = self.model.acquisitions.dataset
+
+        start = self.computed
+        while start < len(self.energy):
+            if job.cancelled():
+                return self.computed
+
+            stop = self.block_stop(start)
+            for row, acquisition in enumerate(dataset[start:stop], start):
+                data = acquisition.data
+                self.energy[row, :data.shape[0]] = np.sum(data.real ** 2 + data.imag ** 2, axis=1)
+
+            self.computed = start = stop
+            job.report(stop)
+
+        return self.computed
+
+    def bins(self, attribute):
+        lines = self.model.column('idx.kspace_encode_step_1').astype(np.int64)
+        columns = self.model.column(attribute).astype(np.int64)
+        columns -= columns.min()
+
+        width = int(columns.max()) + 1
+        if width > self.max_columns:
+            columns = columns * self.max_columns // width
+            width = self.max_columns
+
+        return columns, lines, width, int(lines.max()) + 1
+
+    def image(self, attribute, channel):
+        if not len(self.energy):
+            return np.zeros((1, 1))
+
+        columns, lines, width, height = self.bins(attribute)
+        weights = self.energy.sum(axis=1) if channel is None else self.energy[:, channel]
+        image = np.bincount(lines * width + columns, weights=weights, minlength=width * height)
+        return image.reshape(height, width)
+
+    def rows(self, attribute, column, line):
+        columns, lines, _, _ = self.bins(attribute)
+        return np.flatnonzero((columns == column) & (lines == line))
+
+
+class OccupancyControlGUI(QtWidgets.QWidget):
+
+    def __init__(self, num_channels):
+        super().__init__()
+        layout = QtWidgets.QHBoxLayout()
+
+        self.scan_button = QtWidgets.QPushButton("Scan File")
+        layout.addWidget(self.scan_button)
+
+        self.progress = QtWidgets.QProgressBar()
+        layout.addWidget(self.progress)
+
+        self.axes_selector = QtWidgets.QComboBox()
+        self.axes_selector.addItem("Step1 / Step2", userData=('idx.kspace_encode_step_2', "Encode Step2"))
+        self.axes_selector.addItem("Step1 / Scan Counter", userData=('scan_counter', "Scan Counter (binned)"))
+        layout.addWidget(self.axes_selector)
+
+        self.channel_selector = QtWidgets.QComboBox()
+        self.channel_selector.addItem("All Channels", userData=None)
+        for idx in range(num_channels):
+            self.channel_selector.addItem("Channel " + str(idx), userData=idx)
+        layout.addWidget(self.channel_selector)
+
+        self.setLayout(layout)
+
+    def attribute(self):
+        return self.axes_selector.currentData()[0]
+
+    def label(self):
+        return self.axes_selector.currentData()[1]
+
+    def channel(self):
+        return self.channel_selector.currentData()
+
+
+class OccupancyPlotter(FigureCanvas):
+    clicked = QtCore.Signal(int, int)
+
+    def __init__(self):
+        self.figure = Figure()
+        self.axis = self.figure.subplots(1, 1)
+        self.image = None
+        super().__init__(self.figure)
+
+        self.mpl_connect('button_press_event', self.__pressed)
+
+    def show_map(self, occupancy, label):
+        with np.errstate(divide='ignore'):
+            energy = np.where(occupancy > 0, np.log10(occupancy), np.nan)
+
+        if self.image is None or self.image.get_array().shape != energy.shape:
+            self.axis.clear()
+            self.image = self.axis.imshow(energy, origin='lower', aspect='auto', interpolation='nearest')
+            self.axis.set_ylabel("Encode Step1")
+        else:
+            self.image.set_data(energy)
+
+        finite = energy[np.isfinite(energy)]
+        if finite.size:
+            self.image.set_clim(finite.min(), finite.max())
+
+        self.axis.set_xlabel(label)
+        self.axis.set_title("log10 Energy", loc="right")
+        self.draw_idle()
+
+    def __pressed(self, event):
+        if event.inaxes is not self.axis or event.xdata is None or getattr(self.toolbar, 'mode', ''):
+            return
+        self.clicked.emit(int(round(event.xdata)), int(round(event.ydata)))
+
+
 class AcquisitionViewer(QtWidgets.QSplitter):
 
     def __init__(self, container):
         super().__init__()
 
         self.model = AcquisitionModel(container)
+        self.proxy = HeaderProxyModel(self.model)
+        self.hidden_flags = 0
 
         self.acquisitions = AcquisitionTable(self)
-        self.acquisitions.setModel(self.model)
+        self.acquisitions.setModel(self.proxy)
         self.acquisitions.setAlternatingRowColors(True)
         self.acquisitions.resizeColumnsToContents()
         self.acquisitions.setColumnWidth(1, 96)  # Start the flags out small; full width is a little ostentatious.
         self.acquisitions.selection_changed.connect(self.selection_changed)
         self.acquisitions.pressed.connect(self.mouse_clicked)
 
+        self.presets = SelectionPresetGUI(self.model.encoding_index)
+        self.presets.selected.connect(self.select_counters)
+
+        table_panel = QtWidgets.QWidget()
+        table_layout = QtWidgets.QVBoxLayout(table_panel)
+        table_layout.setContentsMargins(0, 0, 0, 0)
+        table_layout.addWidget(self.presets)
+        table_layout.addWidget(self.acquisitions)
+
         self.setOrientation(Qt.Vertical)
 
         def create_panel(canvas, control):
@@ -396,6 +781,7 @@ class AcquisitionViewer(QtWidgets.QSplitter):
 
             self.acquisition_gui.data_processing.currentIndexChanged.connect(self.selection_changed)
             self.acquisition_gui.channel_selector.currentIndexChanged.connect(self.selection_changed)
+            self.acquisition_gui.fast_render.stateChanged.connect(self.selection_changed)
 
             return create_panel(self.canvas, self.acquisition_gui)
 
@@ -407,50 +793,182 @@ class AcquisitionViewer(QtWidgets.QSplitter):
 
             return create_panel(self.trajectory_canvas, self.trajectory_gui)
 
+        def create_physiology_panel():
+            self.physiology_canvas = PhysiologyPlotter()
+            control = QtWidgets.QLabel("Waveforms during the selected acquisitions")
+
+            panel = create_panel(self.physiology_canvas, control)
+            panel.setVisible(self.time_index is not None)
+            return panel
+
+        def create_occupancy_panel():
+            self.occupancy = OccupancyMap(self.model)
+            self.occupancy_canvas = OccupancyPlotter()
+            self.occupancy_gui = OccupancyControlGUI(self.occupancy.energy.shape[1])
+
+            self.occupancy_gui.scan_button.clicked.connect(self.scan_occupancy)
+            self.occupancy_gui.axes_selector.currentIndexChanged.connect(self.update_occupancy)
+            self.occupancy_gui.channel_selector.currentIndexChanged.connect(self.update_occupancy)
+            self.occupancy_canvas.clicked.connect(self.occupancy_clicked)
+
+            return create_panel(self.occupancy_canvas, self.occupancy_gui)
+
+        # Waveforms recorded alongside the acquisitions, if the container has any.
+        self.time_index = time_index(container)
+        self.waveforms = CachedDataset(container.waveforms) if self.time_index is not None else None
+
         self.data_panel = create_data_panel()
         self.trajectory_panel = create_trajectory_panel()
+        self.physiology_panel = create_physiology_panel()
+        self.occupancy_panel = create_occupancy_panel()
 
-        self.addWidget(self.acquisitions)
+        self.addWidget(table_panel)
         self.addWidget(self.data_panel)
         self.addWidget(self.trajectory_panel)
+        self.addWidget(self.physiology_panel)
+        self.addWidget(self.occupancy_panel)
 
         self.setStretchFactor(0, 6)
         self.setStretchFactor(1, 1)
         self.setStretchFactor(2, 1)
+        self.setStretchFactor(3, 1)
+        self.setStretchFactor(4, 1)
+
+        # Reading and transforming selected acquisitions happens off the GUI thread;
+        # only the result for the most recent selection is drawn.
+        self.loader = LatestTask(self)
+        self.loader.finished.connect(self.selection_loaded)
+
+        self.occupancy_task = LatestTask(self)
+        self.occupancy_task.progress.connect(self.occupancy_progress)
+        self.occupancy_task.finished.connect(self.occupancy_progress)
+        self.occupancy_drawn = 0.0
+
+    def nbytes(self):
+        waveforms = self.waveforms.nbytes if self.waveforms is not None else 0
+        return self.model.acquisitions.nbytes + waveforms + self.occupancy.energy.nbytes
+
+    def release(self):
+        "Stops background work and drops cached acquisitions and waveforms."
+        self.loader.shutdown()
+        self.occupancy_task.shutdown()
+        logging.debug("Acquisition cache: {}".format(self.model.acquisitions.statistics()))
+        self.model.acquisitions.clear()
+        if self.waveforms is not None:
+            self.waveforms.clear()
 
     def table_clicked(self, index):
         acquisition = self.model.acquisitions[index.row()]
         self.plot([acquisition])
 
-    def format_data(self, acq):
-        return self.acquisition_gui.transform_acquisition(acq.data.T)
-
     def selection_changed(self):
-        indices = set([idx.row() for idx in self.acquisitions.selectedIndexes()])
-        acquisitions = [self.model.acquisitions[idx] for idx in indices]
-
-        self.update_canvas(acquisitions)
-        self.update_trajectory(acquisitions)
-
-    def update_canvas(self, acquisitions):
+        indices = self.proxy.source_rows(self.acquisitions.selected_rows())
+        self.update_trajectory_gui(indices)
+        self.loader.submit(self.load_selection, indices, self.acquisition_gui.transform(), self.trajectory_gui.mode())
+
+    def load_selection(self, job, indices, transform, trajectory_mode):
+        "Runs on the loader thread."
+        traces, trajectories = [], []
+        for idx in indices:
+            if job.cancelled():
+                return None
+
+            acquisition = self.model.acquisitions[int(idx)]
+            traces.append(acquisition_trace(acquisition, transform))
+            if acquisition.traj.size:
+                trajectories.append(trajectory_trace(acquisition))
+
+        kind, dim = trajectory_mode
+        if kind == 'k-space':
+            trajectories = [trajectory[:, :dim] for _, _, trajectory in trajectories if trajectory.shape[1] >= dim]
+            trajectories = np.concatenate(trajectories) if trajectories else np.empty((0, dim), dtype=np.float32)
+
+        return traces, (trajectory_mode, trajectories), self.load_physiology(job, indices)
+
+    def load_physiology(self, job, indices, max_windows=64):
+        "Runs on the loader thread; reads the waveform records matching the selected acquisitions."
+        if self.time_index is None:
+            return [], []
+
+        windows = []
+        for row in self.time_index.waveform_rows(indices)[:max_windows]:
+            if job.cancelled():
+                return [], []
+
+            waveform = self.waveforms[int(row)]
+            start = self.time_index.seconds(self.time_index.waveform_starts[row])
+            x = start + np.arange(waveform.data.shape[1]) * waveform.sample_time_us * 1e-6
+            windows.append((int(waveform.waveform_id), x, waveform.data.T))
+
+        markers = self.time_index.seconds(self.time_index.acquisition_times[indices])
+        return windows, markers
+
+    def selection_loaded(self, selection):
+        traces, trajectories, physiology = selection
+
+        self.update_canvas(traces)
+        self.update_trajectory_canvas(*trajectories)
+        if self.time_index is not None:
+            self.physiology_canvas.clear()
+            self.physiology_canvas.plot(*physiology)
+
+    def update_canvas(self, traces):
+        self.canvas.fast = self.acquisition_gui.fast_render.isChecked()
         self.canvas.clear()
         self.canvas.set_titles(self.acquisition_gui.axes_titles())
-        self.canvas.plot(acquisitions, self.format_data, self.acquisition_gui.label)
+        self.canvas.plot(traces, self.acquisition_gui.label)
 
-    def update_trajectory(self, acquisitions):
-        self.trajectory_panel.setVisible(any(acquisition.trajectory_dimensions for acquisition in acquisitions))
-        self.update_trajectory_gui(acquisitions)
-        self.update_trajectory_canvas(acquisitions)
+    def update_trajectory_gui(self, indices):
+        # The header says how many trajectory dimensions there are; no need to load traj for that.
+        dimensions = self.model.column('trajectory_dimensions')[indices]
+        available = int(dimensions.max()) if len(dimensions) else 0
 
-    def update_trajectory_gui(self, acquisitions):
+        self.trajectory_panel.setVisible(available > 0)
         self.trajectory_gui.trajectory_selector.currentIndexChanged.disconnect(self.selection_changed)
-        self.trajectory_gui.update_available_trajectory_dimensions(acquisitions)
+        self.trajectory_gui.update_available_trajectory_dimensions(available)
         self.trajectory_gui.trajectory_selector.currentIndexChanged.connect(self.selection_changed)
 
-    def update_trajectory_canvas(self, acquisitions):
+    def update_trajectory_canvas(self, mode, trajectories):
+        self.trajectory_canvas.set_mode(mode)
         self.trajectory_canvas.clear()
         self.trajectory_canvas.set_title("Trajectory")
-        self.trajectory_canvas.plot(acquisitions, self.trajectory_gui.select)
+        self.trajectory_canvas.plot(mode, trajectories)
+
+    def scan_occupancy(self):
+        self.occupancy_gui.progress.setRange(0, len(self.occupancy.energy))
+        self.occupancy_task.submit(self.occupancy.compute)
+
+    def occupancy_progress(self, computed):
+        self.occupancy_gui.progress.setValue(computed)
+
+        # Redraw a few times a second while the scan is running, and once at the end.
+        if computed == len(self.occupancy.energy) or time.monotonic() - self.occupancy_drawn > 0.5:
+            self.update_occupancy()
+
+    def update_occupancy(self):
+        self.occupancy_drawn = time.monotonic()
+        self.occupancy_canvas.show_map(self.occupancy.image(self.occupancy_gui.attribute(), self.occupancy_gui.channel()),
+                                       self.occupancy_gui.label())
+
+    def occupancy_clicked(self, column, line):
+        rows = np.sort(self.proxy.proxy_rows(self.occupancy.rows(self.occupancy_gui.attribute(), column, line)))
+        if not len(rows):
+            return
+
+        self.acquisitions.select_rows(rows)
+        self.acquisitions.scrollTo(self.proxy.index(int(rows[0]), 0))
+
+    def select_counters(self, counters):
+        rows = self.model.encoding_index.rows(**counters)
+        self.acquisitions.select_rows(np.sort(self.proxy.proxy_rows(rows)))
+
+    def show_flag(self, flag, shown):
+        if shown:
+            self.hidden_flags &= ~flag
+        else:
+            self.hidden_flags |= flag
+
+        self.proxy.set_mask(self.model.flag_mask(self.hidden_flags) if self.hidden_flags else None)
 
     def mouse_clicked(self, index):
         if not QtGui.QGuiApplication.mouseButtons() & Qt.RightButton:
@@ -460,8 +978,15 @@ class AcquisitionViewer(QtWidgets.QSplitter):
         y = index.column()
         DeleteAction.triggered.connect(lambda: self.acquisitions.hideColumn(y))
         menu.addAction(DeleteAction)
-        menu.popup(QtGui.QCursor.pos())
 
-        # SortAction = QtWidgets.QAction('Sort', self)
-        # menu.addAction(SortAction)
+        flags_menu = menu.addMenu('Show Flags')
+        for flag, label in self.model.present_flags():
+            FlagAction = QtWidgets.QAction(label, flags_menu)
+            FlagAction.setCheckable(True)
+            FlagAction.setChecked(not self.hidden_flags & flag)
+            FlagAction.toggled.connect(lambda checked, flag=flag: self.show_flag(flag, checked))
+            flags_menu.addAction(FlagAction)
+
+        menu.addSeparator()
+        add_sort_actions(menu, self.proxy, y)
         menu.popup(QtGui.QCursor.pos())
@@ -0,0 +1,145 @@
+import numpy as np
+
+from PySide2 import QtCore, QtWidgets
+from PySide2.QtCore import Qt
+
+
+def _descending(key):
+    "Returns a key that sorts ascending in the reverse order of key."
+    if len(key) == 0:
+        return key
+    if key.dtype.kind == 'u':
+        return key.max() - key
+    if key.dtype.kind in 'if':
+        return -key.astype(np.float64 if key.dtype.kind == 'f' else np.int64)
+    return -np.unique(key, return_inverse=True)[1].reshape(-1)
+
+
+class HeaderProxyModel(QtCore.QAbstractProxyModel):
+    """
+    Presents the rows of a header table through an index array. Sorting and
+    hiding rows rebuild that array with NumPy, rather than asking the source
+    model about every row the way QSortFilterProxyModel would. The source
+    model provides the columnar keys through sort_key(column).
+    """
+
+    def __init__(self, source):
+        super().__init__()
+        self.setSourceModel(source)
+
+        self.mask = None
+        self.order = None
+        self.sort_keys = []
+        self.__update_rows()
+
+    def set_mask(self, mask):
+        "Shows only the source rows for which mask is true; None shows every row."
+        self.beginResetModel()
+        self.mask = mask
+        self.__update_rows()
+        self.endResetModel()
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        "Makes column the primary sort key, keeping earlier keys as tie-breakers; -1 restores file order."
+        if column < 0:
+            self.sort_by([])
+            return
+
+        keys = [(key, descending) for key, descending in self.sort_keys if key != column]
+        self.sort_by([(column, order == Qt.DescendingOrder)] + keys)
+
+    def sort_by(self, keys):
+        "Sorts by a list of (column, descending) pairs, primary key first."
+        self.layoutAboutToBeChanged.emit()
+
+        persistent = self.persistentIndexList()
+        sources = [self.mapToSource(index) for index in persistent]
+
+        self.sort_keys = list(keys)
+        self.order = self.__order(self.sort_keys)
+        self.__update_rows()
+
+        self.changePersistentIndexList(persistent, [self.mapFromSource(index) for index in sources])
+        self.layoutChanged.emit()
+
+    def __order(self, keys):
+        if not keys:
+            return None
+
+        # np.lexsort treats its last key as the primary one.
+        lexsort_keys = []
+        for column, descending in reversed(keys):
+            key = self.sourceModel().sort_key(column)
+            for component in reversed(key.reshape(len(key), -1).T):
+                lexsort_keys.append(_descending(component) if descending else component)
+
+        return np.lexsort(lexsort_keys)
+
+    def __update_rows(self):
+        count = self.sourceModel().rowCount()
+
+        rows = self.order if self.order is not None else np.arange(count)
+        if self.mask is not None:
+            rows = rows[self.mask[rows]]
+
+        self.rows = rows
+        self.positions = np.full(count, -1, dtype=np.int64)
+        self.positions[rows] = np.arange(len(rows))
+
+    def source_rows(self, rows):
+        "Maps proxy rows to source rows."
+        return self.rows[np.asarray(rows, dtype=np.int64)]
+
+    def proxy_rows(self, rows):
+        "Maps source rows to proxy rows, dropping those that are hidden."
+        positions = self.positions[np.asarray(rows, dtype=np.int64)]
+        return positions[positions >= 0]
+
+    def index(self, row, column, parent=QtCore.QModelIndex()):
+        if parent.isValid() or not 0 <= row < len(self.rows) or not 0 <= column < self.columnCount():
+            return QtCore.QModelIndex()
+        return self.createIndex(row, column)
+
+    def parent(self, index=None):
+        return QtCore.QModelIndex()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else self.sourceModel().columnCount()
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        # Columns are never rearranged, so sections pass straight through;
+        # the default maps them through a row, which fails with no rows shown.
+        if orientation == Qt.Horizontal:
+            return self.sourceModel().headerData(section, orientation, role)
+        return super().headerData(section, orientation, role)
+
+    def mapToSource(self, index):
+        if not index.isValid():
+            return QtCore.QModelIndex()
+        return self.sourceModel().index(int(self.rows[index.row()]), index.column())
+
+    def mapFromSource(self, index):
+        if not index.isValid():
+            return QtCore.QModelIndex()
+        row = self.positions[index.row()]
+        if row < 0:
+            return QtCore.QModelIndex()
+        return self.index(int(row), index.column())
+
+
+def add_sort_actions(menu, proxy, column):
+    ascending = QtWidgets.QAction('Sort Ascending', menu)
+    ascending.triggered.connect(lambda: proxy.sort(column, Qt.AscendingOrder))
+    menu.addAction(ascending)
+
+    descending = QtWidgets.QAction('Sort Descending', menu)
+    descending.triggered.connect(lambda: proxy.sort(column, Qt.DescendingOrder))
+    menu.addAction(descending)
+
+    clear = QtWidgets.QAction('Clear Sort', menu)
+    clear.setEnabled(bool(proxy.sort_keys))
+    clear.triggered.connect(lambda: proxy.sort(-1))
+    menu.addAction(clear)
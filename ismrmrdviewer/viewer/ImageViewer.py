@@ -1,18 +1,550 @@
+import time
 import logging
+import threading
 import numpy
-import pdb
-import matplotlib.pyplot as pyplot
-import matplotlib.animation as animation
 
 from PySide2 import QtCore, QtGui, QtWidgets as QTW
 
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
+from matplotlib.lines import Line2D
+
+from .utils import LRUCache, header_column, container_cache
+from .HeaderProxyModel import HeaderProxyModel, add_sort_actions
+from .workers import LatestTask
 
 DIMS = ('Instance', 'Channel', 'Slice')
 
+# Displayable views of (possibly complex) image data; real data is only shown as 'Real'.
+VIEWS = {
+    'Magnitude': numpy.abs,
+    'Phase': numpy.angle,
+    'Real': numpy.real,
+    'Imaginary': numpy.imag
+}
+
+def is_complex(dtype):
+    "True for complex pixels, including ISMRMRD's compound ('real', 'imag') type, which h5py reads as a structured array."
+    if dtype.names is not None:
+        return {'real', 'imag'} <= set(dtype.names)
+    return numpy.issubdtype(dtype, numpy.complexfloating)
+
+
+def pixels(array):
+    "The array as numbers; compound ('real', 'imag') pixels become complex."
+    if array.dtype.names is None:
+        return array
+
+    real = array['real']
+    result = numpy.empty(real.shape, dtype=numpy.result_type(real.dtype, numpy.complex64))
+    result.real = real
+    result.imag = array['imag']
+    return result
+
+
+def sampled_statistics(data, transform, samples=2**20, max_instances=64):
+    """
+    Estimates window/level statistics of transform(data) from a strided
+    sample of roughly `samples` values, read from at most `max_instances`
+    instances, one instance at a time.
+    """
+    instances, channels, slices, ny, nx = data.shape
+
+    instance_stride = max(-(-instances // max_instances), 1)
+    sampled = len(range(0, instances, instance_stride))
+    per_frame = max(samples // (sampled * channels * slices), 1)
+    stride = max(int(numpy.sqrt(ny * nx / per_frame)), 1)
+
+    sample = transform(numpy.concatenate([pixels(data[instance, :, :, ::stride, ::stride]).ravel()
+                                          for instance in range(0, instances, instance_stride)]))
+
+    v1, v2 = numpy.percentile(sample, (2, 98))
+    return sample.min(), sample.max(), v1, v2
+
+
+def frame_blocks(shape, itemsize, block_bytes=4 * 2**20):
+    "Indices covering (instance, channel, slice, y, x) data in reads of at most one frame, and about block_bytes."
+    instances, channels, slices, ny, nx = shape
+    rows = max(1, min(ny, block_bytes // max(nx * itemsize, 1)))
+    for instance in range(instances):
+        for channel in range(channels):
+            for slice in range(slices):
+                for y in range(0, ny, rows):
+                    yield instance, channel, slice, numpy.s_[y:y + rows]
+
+
+def refined_statistics(job, data, transform, bins=2**16):
+    """
+    Runs on a worker thread. Exact min/max of transform(data) from one
+    streaming pass, and percentiles from a fine histogram in a second. Both
+    read in blocks of part of a frame, so no read holds the file for long.
+    """
+    minimum, maximum = numpy.inf, -numpy.inf
+    for index in frame_blocks(data.shape, data.dtype.itemsize):
+        if job.cancelled():
+            return None
+        block = transform(pixels(data[index]))
+        minimum, maximum = min(minimum, block.min()), max(maximum, block.max())
+
+    counts = numpy.zeros(bins, dtype=numpy.int64)
+    for index in frame_blocks(data.shape, data.dtype.itemsize):
+        if job.cancelled():
+            return None
+        counts += numpy.histogram(transform(pixels(data[index])), bins=bins, range=(minimum, maximum))[0]
+
+    edges = numpy.linspace(minimum, maximum, bins + 1)
+    cumulative = numpy.cumsum(counts) / counts.sum()
+    v1, v2 = edges[numpy.searchsorted(cumulative, (0.02, 0.98))]
+
+    return minimum, maximum, v1, v2
+
+
+def block_mean(frame):
+    "Halves both dimensions of a frame by averaging 2x2 blocks; an odd last row or column is dropped."
+    ny, nx = frame.shape[0] // 2 * 2, frame.shape[1] // 2 * 2
+    return frame[:ny, :nx].reshape(ny // 2, 2, nx // 2, 2).mean(axis=(1, 3))
+
+
+class FrameRing:
+    """
+    Fixed number of slots for prefetched frames, overwritten oldest first.
+    Written by the prefetch thread, read by the GUI thread.
+    """
+
+    def __init__(self, size):
+        self.slots = [None] * size
+        self.index = {}
+        self.position = 0
+        self.lock = threading.Lock()
+
+    def put(self, key, frame):
+        with self.lock:
+            if key in self.index:
+                return
+
+            previous = self.slots[self.position]
+            if previous is not None:
+                del self.index[previous[0]]
+
+            self.slots[self.position] = (key, frame)
+            self.index[key] = self.position
+            self.position = (self.position + 1) % len(self.slots)
+
+    def get(self, key):
+        with self.lock:
+            slot = self.index.get(key)
+            return None if slot is None else self.slots[slot][1]
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def clear(self):
+        with self.lock:
+            self.slots = [None] * len(self.slots)
+            self.index = {}
+            self.position = 0
+
+    def nbytes(self):
+        with self.lock:
+            return sum(slot[1].nbytes for slot in self.slots if slot is not None)
+
+
+class DatasetVolume:
+    """
+    The (slice, y, x) volume of one instance and channel, left in the
+    dataset; indexing it reads only the part asked for, such as one plane.
+    """
+
+    def __init__(self, data, instance, channel):
+        self.data = data
+        self.prefix = (int(instance), int(channel))
+        self.shape = data.shape[2:]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        return self.data[self.prefix + key]
+
+
+class ImageStack:
+    """
+    Frames of an image series, read from the dataset on demand by
+    (instance, channel, slice) and kept in a bounded LRU once decoded.
+    The dataset is laid out as (instance, channel, slice, y, x). During
+    playback, upcoming frames are decoded ahead of time into a ring.
+    Derived views of complex frames (see VIEWS), and downsampled levels of
+    a view (see block_mean), are computed when first asked for and cached
+    next to the frames.
+    """
+
+    byte_budget = 256 * 2**20
+    volume_byte_budget = 128 * 2**20
+    ring_size = 32
+
+    def __init__(self, images):
+        self.data = images.data
+        self.shape = self.data.shape
+        self.dtype = self.data.dtype
+        self.complex = is_complex(self.dtype)
+        self.frames = LRUCache(self.byte_budget)
+        self.views = LRUCache(self.byte_budget // 2)
+        self.levels = LRUCache(self.byte_budget // 4)
+        self.ring = FrameRing(self.ring_size)
+        self.volumes = LRUCache(self.volume_byte_budget)
+        self.mapped = self.__map(self.data)
+
+    @staticmethod
+    def __map(data):
+        "Memory-maps the dataset, if it is stored contiguously and uncompressed."
+        if data.chunks is not None or data.compression is not None:
+            return None
+        offset = data.id.get_offset()
+        if offset is None:
+            return None
+
+        try:
+            return numpy.memmap(data.file.filename, mode='r', dtype=data.dtype, shape=data.shape, offset=offset)
+        except (OSError, ValueError):
+            return None
+
+    def volume(self, instance, channel):
+        """
+        The (slice, y, x) volume of an instance and channel; a view into the
+        memory-mapped file where possible, otherwise read once and cached
+        if it fits volume_byte_budget, otherwise read plane by plane as it
+        is indexed. Pixels are as stored; see pixels() for compound complex
+        data.
+        """
+        if self.mapped is not None:
+            return self.mapped[int(instance), int(channel)]
+
+        if numpy.prod(self.shape[2:]) * self.dtype.itemsize > self.volume_byte_budget:
+            return DatasetVolume(self.data, instance, channel)
+
+        key = (int(instance), int(channel))
+        volume = self.volumes.get(key)
+        if volume is None:
+            volume = self.data[key]
+            self.volumes.put(key, volume)
+        return volume
+
+    def frame(self, instance, channel, slice):
+        key = (int(instance), int(channel), int(slice))
+        frame = self.frames.get(key)
+        if frame is None:
+            frame = self.ring.get(key)
+        if frame is None:
+            frame = pixels(self.data[key])
+        self.frames.put(key, frame)
+        return frame
+
+    def view(self, instance, channel, slice, view='Real'):
+        "The frame as one of VIEWS; real frames are returned as they are."
+        frame = self.frame(instance, channel, slice)
+        if not self.complex:
+            return frame
+
+        key = (int(instance), int(channel), int(slice), view)
+        derived = self.views.get(key)
+        if derived is None:
+            derived = VIEWS[view](frame)
+            self.views.put(key, derived)
+        return derived
+
+    def level(self, instance, channel, slice, level, view='Real'):
+        "The view of the frame, with both dimensions halved `level` times."
+        if level == 0:
+            return self.view(instance, channel, slice, view)
+
+        key = (int(instance), int(channel), int(slice), view, level)
+        frame = self.levels.get(key)
+        if frame is None:
+            frame = block_mean(self.level(instance, channel, slice, level - 1, view))
+            self.levels.put(key, frame)
+        return frame
+
+    def nbytes(self):
+        "Bytes held by the frame caches and the ring."
+        return self.frames.nbytes + self.views.nbytes + self.levels.nbytes + self.volumes.nbytes + self.ring.nbytes()
+
+    def clear(self):
+        "Drops every cached frame, and the memory map."
+        self.frames.clear()
+        self.views.clear()
+        self.levels.clear()
+        self.volumes.clear()
+        self.ring.clear()
+        self.mapped = None
+
+    def level_shape(self, level):
+        ny, nx = self.shape[3:]
+        for _ in range(level):
+            ny, nx = ny // 2, nx // 2
+        return ny, nx
+
+    def tiles(self, job, keys, level, view='Real'):
+        "Runs on the montage loader thread; reports (n, frame) for each of keys at the given level, in order."
+        for n, key in enumerate(keys):
+            if job.cancelled():
+                return
+            job.report((n, self.level(*key, level, view)))
+
+    def prefetch(self, job, keys):
+        "Runs on the prefetch thread; decodes the frames for keys, in order, into the ring."
+        for key in keys:
+            if job.cancelled():
+                return
+            if key in self.ring or key in self.frames:
+                continue
+            self.ring.put(key, pixels(self.data[key]))
+
+image_header_fields = [
+    ('image_index', 'Index', "Image index."),
+    ('image_series_index', 'Series', "Series index."),
+    ('average', 'Average', "Encoding Counters"),
+    ('slice', 'Slice', "Encoding Counters"),
+    ('contrast', 'Contrast', "Encoding Counters"),
+    ('phase', 'Phase', "Encoding Counters"),
+    ('repetition', 'Repetition', "Encoding Counters"),
+    ('set', 'Set', "Encoding Counters"),
+    ('image_type', 'Type', "Magnitude, phase, real, imaginary or complex."),
+    ('acquisition_time_stamp', 'Acquisition Time', "Acquisition time stamp."),
+    ('matrix_size', 'Matrix Size', "Pixels in each dimension."),
+    ('channels', 'Channels', "Number of channels.")
+]
+
+
+class ImageHeaderModel(QtCore.QAbstractTableModel):
+    """
+    Image headers, read once as a structured array. The instance label is
+    formatted up front for every image, so showing a frame is a list lookup
+    rather than a read from the file.
+    """
+
+    label_base = "A{:d}/S{:d}/C{:d}/P{:d}/R{:d}/S{:d}"
+    label_fields = ('average', 'slice', 'contrast', 'phase', 'repetition', 'set')
+
+    def __init__(self, images):
+        super().__init__()
+        self.headers = numpy.asarray(images.headers[:])
+        self.columns = [header_column(self.headers, attribute) for attribute, _, _ in image_header_fields]
+        self.labels = [self.label_base.format(*values)
+                       for values in zip(*(self.headers[name].tolist() for name in self.label_fields))]
+
+    def rowCount(self, _=None):
+        return len(self.headers)
+
+    def columnCount(self, _=None):
+        return len(image_header_fields)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+
+        if orientation == QtCore.Qt.Orientation.Vertical:
+            return None
+
+        _, header, tooltip = image_header_fields[section]
+
+        if role == QtCore.Qt.DisplayRole:
+            return header
+        if role == QtCore.Qt.ToolTipRole:
+            return tooltip
+
+        return None
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole:
+            value = self.columns[index.column()][index.row()]
+            if numpy.ndim(value):
+                return ', '.join([str(item) for item in value])
+            return value.item()
+        if role == QtCore.Qt.ToolTipRole:
+            return image_header_fields[index.column()][2]
+
+        return None
+
+    def sort_key(self, column):
+        return self.columns[column]
+
+    def label(self, instance):
+        return self.labels[instance]
+
+
+class MPRPlotter(FigureCanvas):
+    """
+    Three orthogonal planes of a (slice, y, x) volume through a crosshair;
+    clicking in any plane moves the crosshair there. Planes are basic-indexed
+    out of the volume (see ImageStack.volume), so moving the crosshair reads
+    or copies nothing beyond what is drawn.
+    """
+
+    moved = QtCore.Signal(int)
+    titles = ("Axial", "Coronal", "Sagittal")
+
+    def __init__(self):
+        self.fig = Figure(figsize=(6,6),
+                          dpi=72,
+                          facecolor=(1,1,1),
+                          edgecolor=(0,0,0),
+                          tight_layout=True)
+        self.axes = list(self.fig.subplots(1, 3))
+        super().__init__(self.fig)
+
+        self.volume = None
+        self.transform = None
+        self.clim = (0, 1)
+        self.position = [0, 0, 0]
+        self.images = []
+        self.crosshairs = []
+
+        self.mpl_connect('button_press_event', self.pressed)
+
+    def show_volume(self, volume, transform, clim, z):
+        self.transform = transform
+        self.clim = clim
+        if volume is not self.volume:
+            if self.volume is None or volume.shape != self.volume.shape:
+                self.images = []
+            self.volume = volume
+            self.position = [min(p, n - 1) for p, n in zip(self.position, volume.shape)]
+
+        self.position[0] = min(z, volume.shape[0] - 1)
+        self.update_planes()
+
+    def planes(self):
+        z, y, x = self.position
+        planes = [pixels(plane) for plane in (self.volume[z], self.volume[:, y, :], self.volume[:, :, x])]
+        if self.transform is not None:
+            planes = [self.transform(plane) for plane in planes]
+        return planes, ((x, y), (x, z), (y, z))
+
+    def update_planes(self):
+        planes, crosshairs = self.planes()
+
+        if not self.images:
+            # Crosshairs are plain lines in data coordinates; axvline/axhline
+            # need the axes transform, which is singular while the canvas
+            # has no size yet. Both lists are assigned only once complete.
+            images, lines = [], []
+            for ax, plane, title in zip(self.axes, planes, self.titles):
+                ax.clear()
+                images.append(ax.imshow(plane, cmap='gray', aspect='auto', interpolation='nearest'))
+                vertical, horizontal = Line2D([], [], color='y', linewidth=0.5), Line2D([], [], color='y', linewidth=0.5)
+                ax.add_line(vertical)
+                ax.add_line(horizontal)
+                lines.append((vertical, horizontal))
+                ax.set_xticks([])
+                ax.set_yticks([])
+                ax.set_title(title)
+            self.images, self.crosshairs = images, lines
+
+        for image, plane, (vertical, horizontal), (h, v) in zip(self.images, planes, self.crosshairs, crosshairs):
+            ny, nx = plane.shape
+            image.set_data(plane)
+            image.set_clim(*self.clim)
+            vertical.set_data([h, h], [-0.5, ny - 0.5])
+            horizontal.set_data([-0.5, nx - 0.5], [v, v])
+
+        self.draw_idle()
+
+    def set_clim(self, clim):
+        self.clim = clim
+        for image in self.images:
+            image.set_clim(*clim)
+        self.draw_idle()
+
+    def pressed(self, event):
+        if self.volume is None or event.inaxes not in self.axes or event.xdata is None:
+            return
+
+        h, v = int(round(event.xdata)), int(round(event.ydata))
+        z, y, x = self.position
+        plane = self.axes.index(event.inaxes)
+        if plane == 0:
+            x, y = h, v
+        elif plane == 1:
+            x, z = h, v
+        else:
+            y, z = h, v
+
+        self.position = [min(max(p, 0), n - 1) for p, n in zip((z, y, x), self.volume.shape)]
+        self.update_planes()
+        self.moved.emit(self.position[0])
+
+
+class MontagePlotter(FigureCanvas):
+    """
+    Frames tiled into one preallocated mosaic, shown as a single image with
+    one window/level. Tiles are copied in as they arrive; tiles that have
+    not arrived yet are blank. Clicking a tile picks its index.
+    """
+
+    picked = QtCore.Signal(int)
+
+    def __init__(self):
+        self.fig = Figure(figsize=(6,6),
+                          dpi=72,
+                          facecolor=(1,1,1),
+                          edgecolor=(0,0,0),
+                          tight_layout=True)
+        self.ax = self.fig.add_subplot(111)
+        super().__init__(self.fig)
+
+        self.image = None
+        self.mosaic = None
+        self.indices = []
+        self.columns = 1
+        self.tile_shape = (1, 1)
+
+        self.mpl_connect('button_press_event', self.pressed)
+
+    def layout(self, indices, tile_shape, columns, clim):
+        self.indices = list(indices)
+        self.columns = columns
+        self.tile_shape = tile_shape
+
+        rows = -(-len(self.indices) // columns)
+        ty, tx = tile_shape
+        self.mosaic = numpy.full((rows * ty, columns * tx), numpy.nan, dtype=numpy.float32)
+
+        self.ax.clear()
+        self.image = self.ax.imshow(self.mosaic, vmin=clim[0], vmax=clim[1], cmap='gray', interpolation='nearest')
+        self.ax.set_xticks([])
+        self.ax.set_yticks([])
+        self.draw_idle()
+
+    def set_tile(self, n, tile):
+        row, column = divmod(n, self.columns)
+        ty, tx = self.tile_shape
+        self.mosaic[row * ty:(row + 1) * ty, column * tx:(column + 1) * tx] = tile[:ty, :tx]
+
+    def refresh(self):
+        if self.image is not None:
+            self.image.set_data(self.mosaic)
+            self.draw_idle()
+
+    def set_clim(self, clim):
+        if self.image is not None:
+            self.image.set_clim(*clim)
+            self.draw_idle()
+
+    def pressed(self, event):
+        if self.image is None or event.inaxes is not self.ax or event.xdata is None:
+            return
+
+        ty, tx = self.tile_shape
+        n = int(event.ydata + 0.5) // ty * self.columns + int(event.xdata + 0.5) // tx
+        if 0 <= n < len(self.indices):
+            self.picked.emit(self.indices[n])
+
+
 class ImageViewer(QTW.QWidget):
 
+    # Refine the sampled window/level statistics with an exact pass in the background.
+    # Exact window/level reads the whole series twice; off unless asked for.
+    refine_statistics = False
+    max_tiles = 144
+    render_interval = 16  # ms; about one display refresh
+
     def __init__(self, container):
         """
         Stores off container for later use; sets up the main panel display
@@ -24,6 +556,19 @@ class ImageViewer(QTW.QWidget):
         self.container = container
         logging.info("Image constructor.")
 
+        # Spinboxes, the wheel and window/level drags only ask for a render;
+        # requests arriving within one render_interval are drawn once, with
+        # whatever state is current by then.
+        self.pending = set()
+        self.render_requests = 0
+        self.renders = 0
+        self.coalesced = 0
+        self.rendered_requests = 0
+        self.render_timer = QtCore.QTimer(self)
+        self.render_timer.setSingleShot(True)
+        self.render_timer.setInterval(self.render_interval)
+        self.render_timer.timeout.connect(self.render)
+
         # Main layout
         layout = QTW.QVBoxLayout(self)
 
@@ -41,7 +586,7 @@ class ImageViewer(QTW.QWidget):
             controls.addWidget(QTW.QLabel("{}:".format(dim)))
             self.selected[dim] = QTW.QSpinBox()
             controls.addWidget(self.selected[dim])
-            self.selected[dim].valueChanged.connect(self.update_image)
+            self.selected[dim].valueChanged.connect(lambda: self.request_render('image'))
         self.selected['Instance'].setMaximum(self.nimg - 1)
 
         self.animate = QTW.QCheckBox("Animate:")
@@ -51,8 +596,33 @@ class ImageViewer(QTW.QWidget):
         for dim in DIMS:
             self.animDim.addItem(dim)
         controls.addWidget(self.animDim)
+
+        self.fps = QTW.QSpinBox()
+        self.fps.setRange(1, 60)
+        self.fps.setValue(10)
+        self.fps.setSuffix(" fps")
+        controls.addWidget(self.fps)
+
+        self.mpr_mode = QTW.QCheckBox("MPR")
+        self.mpr_mode.setToolTip("Show orthogonal planes through the slice volume.")
+        controls.addWidget(self.mpr_mode)
+
+        self.montage_mode = QTW.QCheckBox("Montage:")
+        self.montage_mode.setToolTip("Tile the frames along a dimension into one image.")
+        controls.addWidget(self.montage_mode)
+
+        self.montageDim = QTW.QComboBox()
+        for dim in DIMS:
+            self.montageDim.addItem(dim)
+        controls.addWidget(self.montageDim)
         controls.addStretch()
 
+        self.mpr_mode.stateChanged.connect(lambda: self.toggle_mode(self.mpr_mode))
+        self.montage_mode.stateChanged.connect(lambda: self.toggle_mode(self.montage_mode))
+        self.montageDim.currentIndexChanged.connect(self.update_image)
+
+        self.fps.valueChanged.connect(self.set_frame_rate)
+
         self.animate.stateChanged.connect(self.animation)
         self.animDim.currentIndexChanged.connect(self.check_dim)
 
@@ -71,6 +641,16 @@ class ImageViewer(QTW.QWidget):
         controls.addWidget(self.windowScaled)
         controls.addWidget(QTW.QLabel("Level:"))
         controls.addWidget(self.levelScaled)
+
+        self.view = QTW.QComboBox()
+        for view in VIEWS:
+            self.view.addItem(view)
+        controls.addWidget(self.view)
+
+        self.exact = QTW.QPushButton("Exact W/L")
+        self.exact.setToolTip("Set window/level from the whole series, read in the background, rather than a sample.")
+        self.exact.clicked.connect(self.exact_window_level)
+        controls.addWidget(self.exact)
         controls.addStretch()
 
         self.windowScaled.valueChanged.connect(self.window_input)
@@ -88,9 +668,51 @@ class ImageViewer(QTW.QWidget):
         self.canvas.setAttribute(QtCore.Qt.WA_TransparentForMouseEvents)
         self.canvas.setSizePolicy(QTW.QSizePolicy.Expanding,
                                   QTW.QSizePolicy.Expanding)
-        layout.addWidget(self.canvas)
 
-        self.label_base = "A{:d}/S{:d}/C{:d}/P{:d}/R{:d}/S{:d}"
+        self.mpr = MPRPlotter()
+        self.mpr.setSizePolicy(QTW.QSizePolicy.Expanding,
+                               QTW.QSizePolicy.Expanding)
+        self.mpr.setVisible(False)
+        self.mpr.moved.connect(self.mpr_moved)
+
+        self.montage = MontagePlotter()
+        self.montage.setSizePolicy(QTW.QSizePolicy.Expanding,
+                                   QTW.QSizePolicy.Expanding)
+        self.montage.setVisible(False)
+        self.montage.picked.connect(self.montage_picked)
+        self.montage.mpl_connect('resize_event', self.on_montage_resize)
+
+        # Image headers; clicking a row shows that image.
+        self.headers = ImageHeaderModel(self.container.images)
+        self.proxy = HeaderProxyModel(self.headers)
+        self.table = QTW.QTableView()
+        self.table.setModel(self.proxy)
+        self.table.setAlternatingRowColors(True)
+        self.table.setSelectionBehavior(QTW.QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QTW.QAbstractItemView.SingleSelection)
+        self.table.resizeColumnsToContents()
+        self.table.clicked.connect(self.table_clicked)
+        self.table.pressed.connect(self.mouse_clicked)
+
+        splitter = QTW.QSplitter()
+        splitter.setOrientation(QtCore.Qt.Vertical)
+        splitter.addWidget(self.canvas)
+        splitter.addWidget(self.mpr)
+        splitter.addWidget(self.montage)
+        splitter.addWidget(self.table)
+        splitter.setStretchFactor(0, 4)
+        splitter.setStretchFactor(1, 4)
+        splitter.setStretchFactor(2, 4)
+        splitter.setStretchFactor(3, 1)
+        layout.addWidget(splitter)
+
+        # The image is drawn as an animated artist, and blitted over a cached
+        # background when only its data or clim change.
+        self.image = None
+        self.background = None
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.canvas.mpl_connect('resize_event', self.on_resize)
+
         self.label = QTW.QLabel("")
         self.label.setMaximumSize(140, 20)
 
@@ -98,32 +720,127 @@ class ImageViewer(QTW.QWidget):
 
 
         
-        self.stack = numpy.array(self.container.images.data)
+        self.stack = ImageStack(self.container.images)
         if self.stack.shape[0] == 1:
             self.animate.setEnabled(False)
+        self.mpr_mode.setEnabled(self.stack.shape[2] > 1)
 
         logging.info("Container size {}".format(str(self.stack.shape)))
 
-        # Window/Level support
-        self.min = self.stack.min()
-        self.max = self.stack.max()
-        self.range = self.max - self.min
+        # Complex data can be shown as any of VIEWS; real data only as it is.
+        self.view.setCurrentText('Magnitude' if self.stack.complex else 'Real')
+        self.view.setVisible(self.stack.complex)
+        self.view_name = self.view.currentText()
+        self.view.currentIndexChanged.connect(self.view_changed)
 
-        v1 = numpy.percentile(self.stack,2)
-        v2 = numpy.percentile(self.stack,98)
-        self.window = (v2-v1)/self.range
-        self.level = (v2+v1)/2/self.range
+        # Window/Level support; estimated from a sample of the series, and
+        # refined in the background on request (or once the first image is
+        # up, with refine_statistics). Window/level the user has set is kept
+        # per view. Statistics (min, max, 2nd and 98th percentile) per series
+        # and view live in the container's cache, and are dropped with it.
+        self.statistics_cache = container_cache(self.container).setdefault('image_statistics', {})
+        self.wl_states = {}
+        self.statistics_task = LatestTask(self)
+        self.statistics_task.finished.connect(self.statistics_refined)
+        self.load_statistics()
+
+        self.prefetcher = LatestTask(self)
+
+        # Montage tiles are read off the GUI thread and copied in as they arrive.
+        self.montage_key = None
+        self.montage_drawn = 0.0
+        self.montage_loader = LatestTask(self)
+        self.montage_loader.progress.connect(self.montage_progress)
+        self.montage_loader.finished.connect(self.montage_loaded)
 
         self.mloc = None
 
         # For animation
         self.timer = None
 
-        self.selected['Channel'].setMaximum(len(self.stack[0]) - 1)
-        self.selected['Slice'].setMaximum(len(self.stack[0][0]) - 1)
+        self.selected['Channel'].setMaximum(self.stack.shape[1] - 1)
+        self.selected['Slice'].setMaximum(self.stack.shape[2] - 1)
 
         self.update_image()
+        self.update_wl_controls()
+        self.refine()
+
+    def statistics_key(self):
+        return self.stack.data.name, self.view_name
+
+    def load_statistics(self):
+        "Window/level for the current view, from the cache or a fresh sample."
+        statistics = self.statistics_cache.setdefault(self.statistics_key(), {})
+        if 'sampled' not in statistics:
+            statistics['sampled'] = sampled_statistics(self.stack.data, VIEWS[self.view_name])
+
+        self.set_statistics(statistics.get('refined', statistics['sampled']))
+        self.wl_adjusted = False
+
+    def refine(self, requested=False):
+        "Starts the background pass for the current view if enabled or requested, unless it has been done already."
+        key = self.statistics_key()
+        if not (requested or self.refine_statistics) or 'refined' in self.statistics_cache[key]:
+            return
+
+        data, transform = self.stack.data, VIEWS[self.view_name]
+        self.statistics_task.submit(lambda job: (key, refined_statistics(job, data, transform)))
+
+    def exact_window_level(self):
+        "Replaces window/level with that of the whole series, computing it first if need be."
+        self.wl_adjusted = False
+        statistics = self.statistics_cache[self.statistics_key()]
+        if 'refined' not in statistics:
+            self.refine(requested=True)
+            return
+
+        self.set_statistics(statistics['refined'])
+        self.update_wl_controls()
+        self.update_wl()
+
+    def set_statistics(self, statistics):
+        self.min, self.max, v1, v2 = statistics
+        self.range = self.max - self.min
 
+        self.window = (v2-v1)/self.range
+        # window_level() adds min back; level is measured from it.
+        self.level = ((v2+v1)/2 - self.min)/self.range
+
+    def statistics_refined(self, result):
+        "Adopts the refined statistics, unless the user has already set window/level."
+        key, refined = result
+        if refined is None:
+            return
+
+        self.statistics_cache[key]['refined'] = refined
+        if key != self.statistics_key() or self.wl_adjusted:
+            return
+
+        self.set_statistics(refined)
+        self.update_wl_controls()
+        self.update_wl()
+
+    def view_changed(self):
+        "Switches view, bringing back window/level the user set for it, if any."
+        if self.wl_adjusted:
+            self.wl_states[self.view_name] = (self.min, self.max, self.window, self.level)
+        self.view_name = self.view.currentText()
+
+        if self.view_name in self.wl_states:
+            self.min, self.max, self.window, self.level = self.wl_states[self.view_name]
+            self.range = self.max - self.min
+            self.wl_adjusted = True
+        else:
+            self.load_statistics()
+            self.refine()
+
+        self.update_wl_controls()
+        self.image.set_clim(*self.window_level())
+        self.update_image()
+
+    def update_wl_controls(self):
+        # We update the displayed (scaled by self.range) values, but
+        # we don't want extra update_image calls
         for (cont, var) in ((self.windowScaled, self.window),
                             (self.levelScaled, self.level)):
             cont.blockSignals(True)
@@ -153,17 +870,24 @@ class ImageViewer(QTW.QWidget):
         """
         rng = self.window_level()
         self.image.set_clim(*rng)        
-        self.canvas.draw()
+        if self.mpr_mode.isChecked():
+            self.mpr.set_clim(rng)
+        elif self.montage_mode.isChecked():
+            self.montage.set_clim(rng)
+        else:
+            self.blit()
 
     def window_input(self, value, **kwargs):
         "Handles changes in window spinbox; scales to our [0..1] range"
+        self.wl_adjusted = True
         self.window = value / self.range 
-        self.update_wl()
+        self.request_render('wl')
 
     def level_input(self, value):
         "Handles changes in level spinbox; scales to our [0..1] range"
+        self.wl_adjusted = True
         self.level = value / self.range 
-        self.update_wl()
+        self.request_render('wl')
 
     def mouseMoveEvent(self, event):
         "Provides window/level mouse-drag behavior."
@@ -174,6 +898,7 @@ class ImageViewer(QTW.QWidget):
             return 
         
         # Modify mapping and polarity as desired
+        self.wl_adjusted = True
         self.window = self.window - (newx - self.mloc[0]) * 0.01
         self.level = self.level - (newy - self.mloc[1]) * 0.01
 
@@ -188,23 +913,22 @@ class ImageViewer(QTW.QWidget):
         if self.level > 1:
             self.level = 1.0
 
-        # We update the displayed (scaled by self.range) values, but
-        # we don't want extra update_image calls
-        for (cont, var) in ((self.windowScaled, self.window),
-                            (self.levelScaled, self.level)):
-            cont.blockSignals(True)
-            cont.setValue(var * self.range)
-            cont.blockSignals(False)
+        self.update_wl_controls()
 
         self.mloc = (newx, newy)
-        self.update_wl()
+        self.request_render('wl')
 
     def mouseReleaseEvent(self, event):
         "Reset .mloc to indicate we are done with one click/drag operation"
         self.mloc = None
 
     def wheelEvent(self, event):
-        "Handle scroll event; could use some time-based limiting."
+        "Handle scroll event; renders are coalesced through request_render. Ctrl+scroll zooms."
+        if event.modifiers() & QtCore.Qt.ControlModifier:
+            if event.delta():
+                self.zoom(0.8 if event.delta() > 0 else 1.25)
+            return
+
         control = self.selected['Instance']
         if event.delta() > 0:
             new_v = control.value() - 1
@@ -213,6 +937,66 @@ class ImageViewer(QTW.QWidget):
         else:
             return
         control.setValue(max(min(new_v,self.stack.shape[0]-1),0))
+        self.prefetch('Instance', ahead=self.stack.ring_size // 4, behind=self.stack.ring_size // 4)
+
+    def nbytes(self):
+        return self.stack.nbytes()
+
+    def release(self):
+        "Stops playback and background work, and drops cached frames."
+        self.animate.setChecked(False)
+        self.render_timer.stop()
+        for task in (self.statistics_task, self.prefetcher, self.montage_loader):
+            task.shutdown()
+        self.stack.clear()
+
+    def request_render(self, kind):
+        "Asks for the image ('image') or just its window/level ('wl') to be redrawn at the next render."
+        self.render_requests += 1
+        self.pending.add(kind)
+        if not self.render_timer.isActive():
+            self.render_timer.start()
+
+    def render(self):
+        "Draws the current state once for every request since the last render."
+        pending, self.pending = self.pending, set()
+        if 'image' in pending:
+            self.update_image()
+        if 'wl' in pending:
+            self.update_wl()
+        self.renders += 1
+        self.coalesced += self.render_requests - self.rendered_requests - 1
+        self.rendered_requests = self.render_requests
+
+        logging.debug("Rendered {renders} of {requests} requests; {coalesced} coalesced.".format(**self.render_statistics()))
+
+    def render_statistics(self):
+        return {
+            'requests': self.render_requests,
+            'renders': self.renders,
+            'coalesced': self.coalesced
+        }
+
+    def prefetch(self, dim, ahead=0, behind=0):
+        "Queues up the frames next to the current one along dim, nearest first, wrapping around."
+        current = [self.frame(), self.coil(), self.slice()]
+        axis = DIMS.index(dim)
+        count = self.stack.shape[axis]
+
+        offsets = []
+        for step in range(1, max(ahead, behind) + 1):
+            if step <= ahead:
+                offsets.append(step)
+            if step <= behind:
+                offsets.append(-step)
+
+        keys = []
+        for offset in offsets:
+            key = list(current)
+            key[axis] = (key[axis] + offset) % count
+            keys.append(tuple(key))
+
+        self.prefetcher.submit(self.stack.prefetch, keys)
 
     def window_level(self):
         "Perform calculations of (min,max) display range from window/level"
@@ -221,23 +1005,212 @@ class ImageViewer(QTW.QWidget):
                 self.level * self.range
                   + self.window / 2 * self.range + self.min)
     
+    def on_draw(self, event):
+        """
+        Full redraws skip the animated image; keep what they drew as the
+        background for blitting, then draw the image on top.
+        """
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        if self.image is not None:
+            self.ax.draw_artist(self.image)
+
+    def on_resize(self, event):
+        "The canvas size decides the pyramid level."
+        if self.image is not None:
+            self.update_image()
+
+    def blit(self):
+        "Redraws just the image region."
+        if self.background is None:
+            self.canvas.draw()
+            return
+
+        self.canvas.restore_region(self.background)
+        self.ax.draw_artist(self.image)
+        self.canvas.blit(self.ax.bbox)
+
+    def display_level(self):
+        """
+        The coarsest pyramid level that still has a pixel for every screen
+        pixel over the visible part of the frame; zooming in lowers it.
+        """
+        ny, nx = self.stack.shape[3:]
+        width, height = self.ax.bbox.width, self.ax.bbox.height
+        if self.image is None or width < 1 or height < 1:
+            visible = (nx, ny)
+        else:
+            visible = (abs(numpy.diff(self.ax.get_xlim())[0]), abs(numpy.diff(self.ax.get_ylim())[0]))
+
+        ratio = min(visible[0] / max(width, 1), visible[1] / max(height, 1))
+        if ratio < 2:
+            return 0
+        return min(int(numpy.log2(ratio)), int(numpy.log2(min(nx, ny))))
+
+    def display_frame(self):
+        return self.stack.level(self.frame(), self.coil(), self.slice(), self.display_level(), self.view_name)
+
+    def zoom(self, factor):
+        "Scales the visible region about its centre, up to the full frame."
+        ny, nx = self.stack.shape[3:]
+        x0, x1 = self.ax.get_xlim()
+        y1, y0 = self.ax.get_ylim()
+
+        half_x = min(abs(x1 - x0) * factor, nx) / 2
+        half_y = min(abs(y1 - y0) * factor, ny) / 2
+        centre_x = min(max((x0 + x1) / 2, half_x - 0.5), nx - 0.5 - half_x)
+        centre_y = min(max((y0 + y1) / 2, half_y - 0.5), ny - 0.5 - half_y)
+
+        self.ax.set_xlim(centre_x - half_x, centre_x + half_x)
+        self.ax.set_ylim(centre_y + half_y, centre_y - half_y)
+        self.image.set_data(self.display_frame())
+        self.canvas.draw()
+
     def update_image(self, slice_n=None):
         """
         Updates the displayed image when a set of indicies (frame/coil/slice)
-        is selected. Connected to singals from the related spinboxes.
+        is selected. Connected to singals from the related spinboxes. The
+        existing AxesImage is reused; its data comes from the pyramid level
+        matching the canvas, while the extent stays that of the full frame.
         """
-        wl = self.window_level()
-        self.ax.clear()
-        self.image = \
-            self.ax.imshow(self.stack[self.frame()][self.coil()][self.slice()], 
-                           vmin=wl[0],
-                           vmax=wl[1],
-                           cmap=pyplot.get_cmap('gray'))
-        self.ax.set_xticks([])
-        self.ax.set_yticks([])
-        self.canvas.draw()
-        idx = self.container.images.headers[self.frame()]
-        self.label.setText(self.label_base.format(int(idx['average']),int(idx['slice']),int(idx['contrast']),int(idx['phase']),int(idx['repetition']),int(idx['set'])))
+        if self.mpr_mode.isChecked():
+            self.mpr.show_volume(self.stack.volume(self.frame(), self.coil()),
+                                 VIEWS[self.view_name] if self.stack.complex else None,
+                                 self.window_level(),
+                                 self.slice())
+            self.update_label()
+            return
+
+        if self.montage_mode.isChecked():
+            self.update_montage()
+            self.update_label()
+            return
+
+        if self.image is None:
+            ny, nx = self.stack.shape[3:]
+            wl = self.window_level()
+            self.ax.clear()
+            self.image = \
+                self.ax.imshow(self.display_frame(),
+                               vmin=wl[0],
+                               vmax=wl[1],
+                               cmap='gray',
+                               extent=(-0.5, nx - 0.5, ny - 0.5, -0.5),
+                               animated=True)
+            self.ax.set_xticks([])
+            self.ax.set_yticks([])
+            self.canvas.draw()
+        else:
+            self.image.set_data(self.display_frame())
+            self.blit()
+
+        self.update_label()
+
+    def update_label(self):
+        self.label.setText(self.headers.label(self.frame()))
+
+        if self.table.isVisible():
+            rows = self.proxy.proxy_rows([self.frame()])
+            if len(rows):
+                self.table.selectRow(int(rows[0]))
+
+    def table_clicked(self, index):
+        "Shows the image of the clicked header row."
+        self.selected['Instance'].setValue(int(self.proxy.source_rows([index.row()])[0]))
+
+    def mouse_clicked(self, index):
+        if not QtGui.QGuiApplication.mouseButtons() & QtCore.Qt.RightButton:
+            return
+        menu = QTW.QMenu(self)
+        DeleteAction = QTW.QAction('Delete', self)
+        y = index.column()
+        DeleteAction.triggered.connect(lambda: self.table.hideColumn(y))
+        menu.addAction(DeleteAction)
+
+        menu.addSeparator()
+        add_sort_actions(menu, self.proxy, y)
+        menu.popup(QtGui.QCursor.pos())
+
+    def toggle_mode(self, checkbox):
+        "MPR and montage each replace the single image; at most one is on."
+        other = self.montage_mode if checkbox is self.mpr_mode else self.mpr_mode
+        if checkbox.isChecked() and other.isChecked():
+            other.blockSignals(True)
+            other.setChecked(False)
+            other.blockSignals(False)
+
+        mpr, montage = self.mpr_mode.isChecked(), self.montage_mode.isChecked()
+        self.canvas.setVisible(not (mpr or montage))
+        self.mpr.setVisible(mpr)
+        self.montage.setVisible(montage)
+
+        self.montage_key = None
+        if not montage:
+            self.montage_loader.cancel()
+        self.update_image()
+
+    def montage_level(self, columns, rows):
+        "The coarsest pyramid level at which the mosaic still has a pixel for every screen pixel."
+        ny, nx = self.stack.shape[3:]
+        width, height = self.montage.ax.bbox.width, self.montage.ax.bbox.height
+        ratio = min(columns * nx / max(width, 1), rows * ny / max(height, 1))
+        if ratio < 2:
+            return 0
+        return min(int(numpy.log2(ratio)), int(numpy.log2(min(nx, ny))))
+
+    def update_montage(self):
+        """
+        Lays out a mosaic of up to max_tiles frames along the montage
+        dimension, evenly spaced, with the other indices as selected. Only
+        starts over when the layout or its content would change.
+        """
+        axis = self.montageDim.currentIndex()
+        count = self.stack.shape[axis]
+        indices = numpy.unique(numpy.linspace(0, count - 1, min(count, self.max_tiles)).round().astype(int))
+        columns = int(numpy.ceil(numpy.sqrt(len(indices))))
+        rows = -(-len(indices) // columns)
+        level = self.montage_level(columns, rows)
+
+        current = [self.frame(), self.coil(), self.slice()]
+        key = (axis, tuple(current[:axis] + current[axis + 1:]), self.view_name, level)
+        if key == self.montage_key:
+            return
+        self.montage_key = key
+
+        keys = []
+        for index in indices:
+            tile = list(current)
+            tile[axis] = index
+            keys.append(tuple(tile))
+
+        self.montage.layout(indices, self.stack.level_shape(level), columns, self.window_level())
+        self.montage_drawn = time.monotonic()
+        self.montage_loader.submit(self.stack.tiles, keys, level, self.view_name)
+
+    def montage_progress(self, tile):
+        "Copies a tile in; redraws at most a few times a second while tiles arrive."
+        self.montage.set_tile(*tile)
+        if time.monotonic() - self.montage_drawn > 0.1:
+            self.montage_drawn = time.monotonic()
+            self.montage.refresh()
+
+    def montage_loaded(self, _):
+        self.montage.refresh()
+
+    def on_montage_resize(self, event):
+        if self.montage_mode.isChecked():
+            self.update_montage()
+
+    def montage_picked(self, index):
+        "Shows the clicked tile on its own."
+        self.selected[self.montageDim.currentText()].setValue(index)
+        self.montage_mode.setChecked(False)
+
+    def mpr_moved(self, z):
+        "Keeps the slice spinbox on the crosshair, without redrawing."
+        control = self.selected['Slice']
+        control.blockSignals(True)
+        control.setValue(z)
+        control.blockSignals(False)
 
     def animation(self):
         """
@@ -258,13 +1231,31 @@ class ImageViewer(QTW.QWidget):
             return
 
         def increment():
-            "Captures dimName"
+            """
+            Captures dimName. Advances by as many frames as have come due
+            since the last one shown, so a slow render drops frames rather
+            than slowing the animation down.
+            """
+            due = int((time.monotonic() - self.animation_start) * self.fps.value())
+            steps = due - self.animation_frames
+            if steps < 1:
+                return
+            self.animation_frames = due
+
             v = self.selected[dimName].value()
             m = self.selected[dimName].maximum()
-            self.selected[dimName].setValue((v+1) % m)
+            self.selected[dimName].setValue((v + steps) % (m + 1))
+            self.prefetch(dimName, ahead=self.stack.ring_size // 2)
 
         self.timer = QtCore.QTimer(self)
-        self.timer.interval = 100
         self.timer.timeout.connect(increment)
+        self.set_frame_rate(self.fps.value())
         self.timer.start()
 
+    def set_frame_rate(self, fps):
+        "Restarts the frame clock at the new rate."
+        self.animation_start = time.monotonic()
+        self.animation_frames = 0
+        if self.timer:
+            self.timer.setInterval(1000 // fps)
+
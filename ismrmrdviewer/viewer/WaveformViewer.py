@@ -6,12 +6,15 @@ from PySide2.QtCore import Qt
 
 import numpy as np
 import matplotlib as mpl
+from matplotlib.figure import Figure
 
 from matplotlib.backends.backend_qt5agg import FigureCanvas
 from .AcquisitionViewer import AcquisitionTable
 
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
-from .utils import CachedDataset
+from .utils import CachedDataset, read_headers, header_column, minmax_decimate, MinMaxPyramid, time_stamp_tick, time_index
+from .HeaderProxyModel import HeaderProxyModel, add_sort_actions
+from .workers import LatestTask
 
 # RR: example waveform headers are not arrays
 waveform_header_fields = [
@@ -26,6 +29,70 @@ waveform_header_fields = [
     ('waveform_id', 'Waveform ID', "Waveform ID.")
 ]
 
+# Waveform IDs defined by ISMRMRD; others are vendor or user defined.
+waveform_names = {
+    0: 'ECG',
+    1: 'Pulse',
+    2: 'Respiratory',
+    3: 'External 1',
+    4: 'External 2'
+}
+
+
+def waveform_name(waveform_id):
+    return waveform_names.get(waveform_id, "Waveform {}".format(waveform_id))
+
+
+def build_timelines(job, waveforms, headers, waveform_ids, origin=None, preview_bins=1024, chunk=512):
+    """
+    Runs on a worker thread. Concatenates the records of each waveform ID,
+    in time stamp order, into one trace with time in seconds from origin,
+    by default the first waveform time stamp; gaps between records are
+    marked by NaN.
+    Reports a decimated (waveform_id, x, y) preview of every `chunk`
+    records, and returns a MinMaxPyramid per waveform ID.
+    """
+    time_stamps = headers['time_stamp'].astype(np.float64)
+    if origin is None:
+        origin = time_stamps.min() if len(time_stamps) else 0.0
+
+    timelines = {}
+    for waveform_id in waveform_ids:
+        rows = np.flatnonzero(headers['waveform_id'] == waveform_id)
+        rows = rows[np.argsort(time_stamps[rows], kind='stable')]
+
+        xs, ys, reported, pending = [], [], 0, 0
+        end = -np.inf
+        for row in rows:
+            if job.cancelled():
+                return None
+
+            waveform = waveforms[int(row)]
+            samples = waveform.data.T.astype(np.float32)
+            step = waveform.sample_time_us * 1e-6
+            start = (time_stamps[row] - origin) * time_stamp_tick
+
+            if xs and start > end + 1.5 * step:
+                xs.append(np.array([end + step]))
+                ys.append(np.full((1, samples.shape[1]), np.nan, dtype=np.float32))
+            xs.append(start + np.arange(samples.shape[0]) * step)
+            ys.append(samples)
+            end = xs[-1][-1] if len(xs[-1]) else start
+
+            pending += 1
+            if pending == chunk:
+                x, y = np.concatenate(xs[reported:]), np.concatenate(ys[reported:])
+                job.report((waveform_id,) + minmax_decimate(x, y, preview_bins))
+                reported, pending = len(xs), 0
+
+        if not xs:
+            continue
+        x, y = np.concatenate(xs), np.concatenate(ys)
+        timelines[waveform_id] = MinMaxPyramid(x, y)
+
+    return timelines
+
+
 class WaveformModel(QtCore.QAbstractTableModel):
 
     def __init__(self, container):
@@ -33,12 +100,14 @@ class WaveformModel(QtCore.QAbstractTableModel):
 
         self.container = container
         self.waveforms = CachedDataset(container.waveforms)
+        self.headers = read_headers(container, 'waveforms')
+        self.columns = [header_column(self.headers, attribute) for attribute, _, _ in waveform_header_fields]
 
         logging.info("Waveform constructor.")
 
 
     def rowCount(self, _=None):
-        return len(self.waveforms)
+        return len(self.headers)
 
     def columnCount(self, _=None):
         return len(waveform_header_fields)
@@ -58,16 +127,17 @@ class WaveformModel(QtCore.QAbstractTableModel):
         return None
 
     def data(self, index, role=Qt.DisplayRole):
-        waveform = self.waveforms[index.row()]
-        attribute, _, tooltip = waveform_header_fields[index.column()]
-
+        # Served from the headers alone; payloads are only read when plotted.
         if role == Qt.DisplayRole:
-            return getattr(waveform,attribute)
+            return self.columns[index.column()][index.row()].item()
         if role == Qt.ToolTipRole:
-            return tooltip
+            return waveform_header_fields[index.column()][2]
 
         return None
 
+    def sort_key(self, column):
+        return self.columns[column]
+
 
 class WaveformControlGUI(QtWidgets.QWidget):
 
@@ -78,6 +148,10 @@ class WaveformControlGUI(QtWidgets.QWidget):
         self.__set_num_channels(1)
         layout.addWidget(self.channel_selector)
 
+        self.timeline = QtWidgets.QCheckBox("Timeline")
+        self.timeline.setToolTip("Show every record of the selected waveform IDs as one continuous trace.")
+        layout.addWidget(self.timeline)
+
         self.setLayout(layout)
 
     def __set_num_channels(self, num_channels):
@@ -103,7 +177,7 @@ class WaveformPlotter(FigureCanvas):
 
     def __init__(self):
 
-        self.figure = mpl.figure.Figure()
+        self.figure = Figure()
         self.axis = self.figure.subplots(2, 1, sharex='col')
         self.figure.subplots_adjust(hspace=0)
 
@@ -111,9 +185,92 @@ class WaveformPlotter(FigureCanvas):
         self.figure.legends.append(self.legend)
         super().__init__(self.figure)
 
+        self.timeline_lines = []
+        self.previews = {}
+        self.preview_lines = {}
+        self.axis[0].callbacks.connect('xlim_changed', self.__zoom_timeline)
+
     def clear(self):
+        self.timeline_lines = []
+        self.previews = {}
+        self.preview_lines = {}
         for ax in self.axis:
             ax.clear()
+        # Clearing the axes also drops their callbacks.
+        self.axis[0].callbacks.connect('xlim_changed', self.__zoom_timeline)
+
+    def preview_timeline(self, waveform_id, x, y, formatter):
+        "Extends the preview trace of a waveform ID while its timeline is being built."
+        xs, ys = self.previews.setdefault(waveform_id, ([], []))
+        xs.append(x)
+        ys.append(formatter(y))
+
+        lines = self.preview_lines.get(waveform_id)
+        x, y = np.concatenate(xs), np.concatenate(ys)
+        if lines is None:
+            self.preview_lines[waveform_id] = self.axis[0].plot(x, y, linewidth=0.5)
+        else:
+            for chan, line in enumerate(lines):
+                line.set_data(x, y[:, chan])
+        self.axis[0].relim()
+        self.axis[0].autoscale_view()
+        self.draw_idle()
+
+    def show_timelines(self, timelines, formatter):
+        """
+        Draws one trace per channel of each waveform ID, over the whole
+        timeline; zooming redraws from the pyramid level that matches.
+        """
+        self.clear()
+        if not timelines:
+            self.draw_idle()
+            return
+
+        extents = [timeline.extent for timeline in timelines.values()]
+        start, stop = min(e[0] for e in extents), max(e[1] for e in extents)
+        points = self.__points()
+
+        for waveform_id, timeline in timelines.items():
+            x, y = timeline.window(start, stop, points)
+            y = formatter(y)
+            for chan in range(y.shape[1]):
+                line, = self.axis[0].plot(x, y[:, chan], linewidth=0.5,
+                                          label="{} {}".format(waveform_name(waveform_id), chan))
+                self.timeline_lines.append((line, timeline, formatter, chan))
+
+        self.axis[0].set_xlim(start, stop)
+        self.axis[0].set_xlabel("Time (s)")
+
+        handles, labels = self.axis[0].get_legend_handles_labels()
+        self.legend = mpl.legend.Legend(self.figure, handles, labels)
+        self.figure.legends[0] = self.legend
+
+        self.draw_idle()
+
+    def mark_acquisitions(self, positions):
+        "Draws a line at each of the given positions, where acquisitions were made."
+        if len(positions):
+            self.axis[0].vlines(positions, 0, 1, transform=self.axis[0].get_xaxis_transform(),
+                                colors='k', alpha=0.3, label="Acquisitions")
+            self.draw_idle()
+
+    def __points(self):
+        return max(int(self.axis[0].bbox.width), 1)
+
+    def __zoom_timeline(self, ax):
+        if not self.timeline_lines:
+            return
+
+        start, stop = ax.get_xlim()
+        points = self.__points()
+        windows = {}
+        for line, timeline, formatter, chan in self.timeline_lines:
+            if id(timeline) not in windows:
+                x, y = timeline.window(start, stop, points)
+                windows[id(timeline)] = (x, formatter(y))
+            x, y = windows[id(timeline)]
+            line.set_data(x, y[:, chan])
+        self.draw_idle()
 
     def plot(self, waveforms,  formatter, labeler):
 
@@ -141,12 +298,15 @@ class WaveformViewer(QtWidgets.QSplitter):
         super().__init__()
 
         self.model = WaveformModel(container)
+        self.proxy = HeaderProxyModel(self.model)
+        self.time_index = time_index(container)
 
         self.waveforms = AcquisitionTable(self)
-        self.waveforms.setModel(self.model)
+        self.waveforms.setModel(self.proxy)
         self.waveforms.setAlternatingRowColors(True)
         self.waveforms.resizeColumnsToContents()
         self.waveforms.selection_changed.connect(self.selection_changed)
+        self.waveforms.pressed.connect(self.mouse_clicked)
 
         self.setOrientation(Qt.Vertical)
 
@@ -156,6 +316,7 @@ class WaveformViewer(QtWidgets.QSplitter):
         self.waveform_gui = WaveformControlGUI()
         self.bottom_view.addWidget(self.waveform_gui)
         self.waveform_gui.channel_selector.currentIndexChanged.connect(self.selection_changed)
+        self.waveform_gui.timeline.stateChanged.connect(self.selection_changed)
 
         self.addWidget(self.waveforms)
         self.addWidget(self.canvas)
@@ -167,6 +328,24 @@ class WaveformViewer(QtWidgets.QSplitter):
         self.setStretchFactor(0, 6)
         self.setStretchFactor(1, 1)
 
+        # Timelines are built off the GUI thread, once per waveform ID.
+        self.timelines = {}
+        self.timeline_task = LatestTask(self)
+        self.timeline_task.progress.connect(self.timeline_progress)
+        self.timeline_task.finished.connect(self.timeline_loaded)
+        self.shown_timelines = []
+        self.shown_acquisitions = []
+
+    def nbytes(self):
+        return self.model.waveforms.nbytes + sum(timeline.nbytes for timeline in self.timelines.values())
+
+    def release(self):
+        "Stops background work and drops cached waveforms and timelines."
+        self.timeline_task.shutdown()
+        self.timelines.clear()
+        logging.debug("Waveform cache: {}".format(self.model.waveforms.statistics()))
+        self.model.waveforms.clear()
+
     def table_clicked(self, index):
         waveform = self.model.waveforms[index.row()]
         self.plot([waveform])
@@ -177,7 +356,69 @@ class WaveformViewer(QtWidgets.QSplitter):
     def selection_changed(self):
         self.canvas.clear()
 
-        indices = set([idx.row() for idx in self.waveforms.selectedIndexes()])
-        waveforms = [self.model.waveforms[idx] for idx in
+        indices = self.proxy.source_rows(self.waveforms.selected_rows())
+        if self.waveform_gui.timeline.isChecked():
+            self.show_timelines(indices)
+            return
+
+        self.timeline_task.cancel()
+        waveforms = [self.model.waveforms[int(idx)] for idx in
                         indices]
         self.canvas.plot(waveforms, self.waveform_gui.transform_waveform, self.waveform_gui.label)
+        self.canvas.mark_acquisitions(self.acquisition_offsets(indices))
+
+    def acquisition_offsets(self, indices):
+        "Times of the acquisitions made during each record, in microseconds from the start of that record."
+        if self.time_index is None:
+            return []
+
+        index = self.time_index
+        offsets = [(index.acquisition_times[index.acquisition_rows([row])] - index.waveform_starts[row]) * time_stamp_tick * 1e6
+                   for row in indices]
+        return np.concatenate(offsets) if offsets else []
+
+    def acquisition_times(self, indices):
+        "Times of the acquisitions made during any of the records, in seconds on the timeline."
+        if self.time_index is None:
+            return []
+        return self.time_index.seconds(self.time_index.acquisition_times[self.time_index.acquisition_rows(indices)])
+
+    def show_timelines(self, indices):
+        "Shows the timelines of the waveform IDs among the selected rows, building those not seen yet."
+        waveform_ids = [int(i) for i in np.unique(self.model.headers['waveform_id'][indices])]
+        missing = [i for i in waveform_ids if i not in self.timelines]
+
+        self.shown_timelines = waveform_ids
+        self.shown_acquisitions = self.acquisition_times(indices)
+        if missing:
+            origin = self.time_index.origin if self.time_index is not None else None
+            self.timeline_task.submit(build_timelines, self.model.waveforms, self.model.headers, missing, origin)
+        else:
+            self.timeline_task.cancel()
+            self.timeline_loaded({})
+
+    def timeline_progress(self, preview):
+        waveform_id, x, y = preview
+        self.canvas.preview_timeline(waveform_id, x, y, self.waveform_gui.transform_waveform)
+
+    def timeline_loaded(self, timelines):
+        if timelines is None:
+            return
+        self.timelines.update(timelines)
+        self.canvas.show_timelines({i: self.timelines[i] for i in self.shown_timelines if i in self.timelines},
+                                   self.waveform_gui.transform_waveform)
+        self.canvas.mark_acquisitions(self.shown_acquisitions)
+
+    def mouse_clicked(self, index):
+        if not QtGui.QGuiApplication.mouseButtons() & Qt.RightButton:
+            return
+        menu = QtWidgets.QMenu(self)
+        DeleteAction = QtWidgets.QAction('Delete', self)
+        y = index.column()
+        DeleteAction.triggered.connect(lambda: self.waveforms.hideColumn(y))
+        menu.addAction(DeleteAction)
+
+        menu.addSeparator()
+        add_sort_actions(menu, self.proxy, y)
+        menu.popup(QtGui.QCursor.pos())
+
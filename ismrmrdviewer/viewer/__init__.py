@@ -1,7 +1,6 @@
 
-from .HeaderViewer import HeaderViewer
-from .ImageViewer import ImageViewer
-from .AcquisitionViewer import AcquisitionViewer
-from .WaveformViewer import WaveformViewer
-
+# Viewer modules pull in matplotlib and friends, so nothing is imported
+# here; ismrmrdviewer.ui.FileWidget imports each viewer module on first use.
+# The names below are the submodules; import a viewer class from its module,
+# e.g. `from ismrmrdviewer.viewer.ImageViewer import ImageViewer`.
 __all__ = ["HeaderViewer", "ImageViewer", "AcquisitionViewer", "WaveformViewer"]
@@ -1,27 +1,342 @@
+import threading
+
 from collections import OrderedDict
 
+import numpy as np
+
+
+def payload_size(item):
+    return sum(getattr(item, name).nbytes for name in ('data', 'traj') if hasattr(item, name))
+
+
 class CachedDataset :
 
-    def __init__(self, dataset, buffer_size : int = 1024  ):
-        self.buffer_size = buffer_size
+    default_byte_budget = 256 * 2**20
+
+    def __init__(self, dataset, byte_budget : int = None, block_size : int = 64, sizeof=payload_size):
+        self.byte_budget = byte_budget or CachedDataset.default_byte_budget
+        self.block_size = block_size
+        self.sizeof = sizeof
         self.dataset = dataset
         self.buffer = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+        self.last_key = None
+        self.last_block = (0, 0)
+        self.item_size = None
+        self.hits = 0
+        self.misses = 0
+        self.readaheads = 0
 
     def __getitem__(self, key):
+        with self.lock:
+            return self.__get(key)
+
+    def __get(self, key):
+
+        # Only sequential access reads ahead: a step to the neighbouring row,
+        # or back into the block read last. Strided and random access read
+        # just the row asked for.
+        sequential = self.last_key is not None and (abs(key - self.last_key) == 1 or
+                                                    self.last_block[0] <= key < self.last_block[1])
+        forward = self.last_key is None or key >= self.last_key
+        self.last_key = key
+
+        if key in self.buffer:
+            self.hits += 1
+            item, _ = self.buffer[key]
+            self.buffer.move_to_end(key)
+            return item
+
+        self.misses += 1
+        return self.__read_block(key, forward, sequential)
+
+    def __block_length(self):
+        # As many items as fit in half the budget, going by the size of the last
+        # item read; a single item until we know how large items are.
+        if self.item_size is None:
+            return 1
+        return max(1, min(self.block_size, self.byte_budget // (2 * max(self.item_size, 1))))
+
+    def __read_block(self, key, forward, sequential):
+        # Read ahead in the direction we are moving, stopping short of anything we already hold.
+        length = self.__block_length() if sequential else 1
+        if forward:
+            start, stop = key, key + 1
+            while stop < min(key + length, len(self)) and stop not in self.buffer:
+                stop += 1
+        else:
+            start, stop = key, key + 1
+            while start > max(key - length + 1, 0) and start - 1 not in self.buffer:
+                start -= 1
+
+        items = self.dataset[start:stop]
+        self.last_block = (start, stop)
+        self.readaheads += len(items) - 1
+
+        # Farthest first, so the items needed next are the last to be evicted,
+        # and the requested item last of all.
+        indices = reversed(range(start, stop)) if forward else range(start, stop)
+        for index in indices:
+            self.__buffer_value(index, items[index - start])
+
+        self.item_size = self.sizeof(items[key - start])
+        self.__evict()
+        return items[key - start]
 
+    def __buffer_value(self, key, item):
         if key in self.buffer:
-            acq = self.buffer[key]
             self.buffer.move_to_end(key)
-            return acq
+            return
+        size = self.sizeof(item)
+        self.buffer[key] = (item, size)
+        self.nbytes += size
 
-        acq = self.dataset[key]
-        self.__buffer_value(key,acq)
-        return acq
+    def __evict(self):
+        while self.nbytes > self.byte_budget and len(self.buffer) > 1:
+            _, (_, size) = self.buffer.popitem(last=False)
+            self.nbytes -= size
 
-    def __buffer_value(self,key,acq ):
-        self.buffer[key] = acq
-        if len(self.buffer) > self.buffer_size:
-            self.buffer.popitem(last=False)
+    def clear(self):
+        with self.lock:
+            self.buffer.clear()
+            self.nbytes = 0
+
+    def statistics(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'readaheads': self.readaheads,
+            'items': len(self.buffer),
+            'bytes': self.nbytes,
+            'byte_budget': self.byte_budget
+        }
 
     def __len__(self):
         return self.dataset.data.size
+
+
+class LRUCache:
+
+    def __init__(self, byte_budget, sizeof=lambda value: value.nbytes):
+        self.byte_budget = byte_budget
+        self.sizeof = sizeof
+        self.items = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key][0]
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.items:
+                self.nbytes -= self.items.pop(key)[1]
+
+            size = self.sizeof(value)
+            self.items[key] = (value, size)
+            self.nbytes += size
+
+            while self.nbytes > self.byte_budget and len(self.items) > 1:
+                _, (_, size) = self.items.popitem(last=False)
+                self.nbytes -= size
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.nbytes = 0
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+
+def container_cache(container):
+    """
+    Data shared by the viewers of one container, such as its header arrays
+    and time index. It lives on the container, which the file tree opens
+    once per group, and goes with it; release_container_cache() drops it
+    sooner.
+    """
+    cache = getattr(container, 'viewer_cache', None)
+    if cache is None:
+        cache = container.viewer_cache = {}
+    return cache
+
+
+def release_container_cache(container):
+    if getattr(container, 'viewer_cache', None) is not None:
+        container.viewer_cache.clear()
+
+
+def read_headers(container, name):
+    "Headers of the container's `name` dataset (acquisitions or waveforms), read once per container."
+    cache = container_cache(container)
+    if name not in cache:
+        # Reading a single member of the compound type leaves the variable-length
+        # payload members (data, traj) on disk.
+        cache[name] = getattr(container, name).data['head']
+    return cache[name]
+
+
+def header_column(headers, attribute):
+    for name in attribute.split('.'):
+        headers = headers[name]
+    return headers
+
+
+def row_ranges(rows):
+    # Splits sorted rows into (start, stop) runs of consecutive values.
+    rows = np.asarray(rows, dtype=np.int64)
+    if len(rows) == 0:
+        return []
+
+    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+    starts = rows[np.r_[0, breaks]]
+    stops = rows[np.r_[breaks - 1, len(rows) - 1]] + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def minmax_decimate(x, y, bins):
+    # Reduces y (samples along the first axis) to the minimum and maximum of each of
+    # bins intervals, which keeps the envelope of the trace at a given pixel width.
+    count = y.shape[0]
+    if count <= 2 * bins:
+        return x, y
+
+    starts = np.linspace(0, count, bins + 1).astype(np.int64)[:-1]
+    stops = np.r_[starts[1:], count]
+
+    decimated = np.empty((2 * bins,) + y.shape[1:], dtype=y.dtype)
+    decimated[0::2] = np.minimum.reduceat(y, starts, axis=0)
+    decimated[1::2] = np.maximum.reduceat(y, starts, axis=0)
+
+    positions = np.empty(2 * bins, dtype=x.dtype)
+    positions[0::2] = x[starts]
+    positions[1::2] = x[stops - 1]
+
+    return positions, decimated
+
+
+# Acquisition and waveform time stamps count ticks of 2.5 ms.
+time_stamp_tick = 2.5e-3
+
+
+class MinMaxPyramid:
+    """
+    Envelope of a trace (samples along the first axis) at successively
+    halved resolutions; level k holds the minimum and maximum of every
+    2**k samples. Any window of the trace can then be drawn with about as
+    many points as there are pixels, whatever the zoom. Gaps marked with
+    NaN are kept at full resolution and skipped at coarser levels.
+    """
+
+    def __init__(self, x, y):
+        self.levels = [(x, y, y)]
+        low, high = y, y
+        while len(x) > 1:
+            count = len(x) // 2 * 2
+            x = x[:count:2]
+            low = np.fmin(low[:count:2], low[1:count:2])
+            high = np.fmax(high[:count:2], high[1:count:2])
+            self.levels.append((x, low, high))
+
+    @property
+    def nbytes(self):
+        x, y, _ = self.levels[0]
+        return x.nbytes + y.nbytes + sum(x.nbytes + low.nbytes + high.nbytes for x, low, high in self.levels[1:])
+
+    @property
+    def extent(self):
+        x = self.levels[0][0]
+        return (x[0], x[-1]) if len(x) else (0.0, 0.0)
+
+    def window(self, start, stop, points):
+        "The finest level with at most `points` samples between start and stop, interleaving minima and maxima."
+        for level, (x, low, high) in enumerate(self.levels):
+            first, last = np.searchsorted(x, (start, stop))
+            first, last = max(first - 1, 0), min(last + 1, len(x))
+            if last - first <= points:
+                break
+
+        if level == 0:
+            return x[first:last], low[first:last]
+
+        positions = np.repeat(x[first:last], 2)
+        values = np.empty((2 * (last - first),) + low.shape[1:], dtype=low.dtype)
+        values[0::2] = low[first:last]
+        values[1::2] = high[first:last]
+        return positions, values
+
+
+class TimeIndex:
+    """
+    Joins acquisitions and waveforms of one container on their time stamps.
+    Acquisition time stamps are sorted once, and so are the records of each
+    waveform ID by start; a lookup is then a searchsorted per row. Times
+    are in time stamp ticks; seconds() converts them to seconds from the
+    earliest time stamp of either.
+    """
+
+    def __init__(self, acquisition_headers, waveform_headers):
+        self.acquisition_times = acquisition_headers['acquisition_time_stamp'].astype(np.float64)
+        self.acquisition_order = np.argsort(self.acquisition_times, kind='stable')
+        self.sorted_times = self.acquisition_times[self.acquisition_order]
+
+        ticks = waveform_headers['number_of_samples'] * (waveform_headers['sample_time_us'] * 1e-6 / time_stamp_tick)
+        self.waveform_starts = waveform_headers['time_stamp'].astype(np.float64)
+        self.waveform_ends = self.waveform_starts + ticks
+
+        ids = waveform_headers['waveform_id']
+        self.waveforms = {}
+        for waveform_id in np.unique(ids):
+            rows = np.flatnonzero(ids == waveform_id)
+            rows = rows[np.argsort(self.waveform_starts[rows], kind='stable')]
+            self.waveforms[int(waveform_id)] = (rows, self.waveform_starts[rows], self.waveform_ends[rows])
+
+        times = np.concatenate((self.acquisition_times, self.waveform_starts))
+        self.origin = times.min() if len(times) else 0.0
+
+    def seconds(self, ticks):
+        return (np.asarray(ticks, dtype=np.float64) - self.origin) * time_stamp_tick
+
+    def waveform_rows(self, acquisition_rows):
+        "Sorted rows of the waveform records, of any ID, that were recording during the given acquisitions."
+        times = self.acquisition_times[np.asarray(acquisition_rows, dtype=np.int64)]
+
+        matches = []
+        for rows, starts, ends in self.waveforms.values():
+            positions = np.searchsorted(starts, times, side='right') - 1
+            covered = positions >= 0
+            covered[covered] = ends[positions[covered]] >= times[covered]
+            matches.append(rows[positions[covered]])
+
+        return np.unique(np.concatenate(matches)) if matches else np.empty(0, dtype=np.int64)
+
+    def acquisition_rows(self, waveform_rows):
+        "Sorted rows of the acquisitions made while the given waveform records were recording."
+        waveform_rows = np.asarray(waveform_rows, dtype=np.int64)
+        firsts = np.searchsorted(self.sorted_times, self.waveform_starts[waveform_rows], side='left')
+        lasts = np.searchsorted(self.sorted_times, self.waveform_ends[waveform_rows], side='right')
+
+        matches = [self.acquisition_order[first:last] for first, last in zip(firsts, lasts)]
+        return np.unique(np.concatenate(matches)) if matches else np.empty(0, dtype=np.int64)
+
+
+def time_index(container):
+    "The TimeIndex of a container with both acquisitions and waveforms, built once per container; None otherwise."
+    available = container.available()
+    if 'acquisitions' not in available or 'waveforms' not in available:
+        return None
+
+    cache = container_cache(container)
+    if 'time_index' not in cache:
+        cache['time_index'] = TimeIndex(read_headers(container, 'acquisitions'), read_headers(container, 'waveforms'))
+    return cache['time_index']
@@ -0,0 +1,84 @@
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide2 import QtCore
+
+
+class Job:
+
+    def __init__(self, task, generation):
+        self.task = task
+        self.generation = generation
+
+    def cancelled(self):
+        "True once a newer job has been submitted to the same task."
+        return self.generation != self.task.generation
+
+    def report(self, value):
+        "Passes an intermediate result to the task's progress signal."
+        if not self.cancelled():
+            self.task._progressed.emit(self.generation, value)
+
+
+class LatestTask(QtCore.QObject):
+    """
+    Runs functions on a worker thread, one at a time. Every submission gets
+    a new generation id; jobs from older generations are skipped, or
+    abandoned if the function polls job.cancelled(), and only the result of
+    the newest job is delivered through the finished signal on the GUI thread.
+    Long-running jobs can pass intermediate results to the progress signal
+    with job.report(value). Tasks are shut down when the application quits,
+    so jobs that poll job.cancelled() do not hold up exit.
+    """
+
+    finished = QtCore.Signal(object)
+    progress = QtCore.Signal(object)
+    _completed = QtCore.Signal(int, object)
+    _progressed = QtCore.Signal(int, object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.generation = 0
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._completed.connect(self.__deliver)
+        self._progressed.connect(self.__report)
+
+        app = QtCore.QCoreApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(self.shutdown)
+
+    def submit(self, function, *args):
+        "Calls function(job, *args) on the worker thread."
+        self.generation += 1
+        job = Job(self, self.generation)
+        self.executor.submit(self.__run, job, function, args)
+        return job
+
+    def cancel(self):
+        self.generation += 1
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
+
+    def __run(self, job, function, args):
+        if job.cancelled():
+            return
+
+        try:
+            result = function(job, *args)
+        except Exception:
+            logging.exception("Background job failed.")
+            return
+
+        if not job.cancelled():
+            self._completed.emit(job.generation, result)
+
+    def __deliver(self, generation, result):
+        if generation == self.generation:
+            self.finished.emit(result)
+
+    def __report(self, generation, value):
+        if generation == self.generation:
+            self.progress.emit(value)